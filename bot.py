@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import io
 import os
+import re
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import asyncio
 import logging
 import logging.handlers
-from typing import Literal, Optional
+from datetime import datetime, timedelta
+from typing import Dict, Literal, Optional, Union
 
 import discord
 from discord.ext import commands
@@ -13,31 +23,85 @@ from dotenv import load_dotenv
 load_dotenv()
 BOT_TOKEN = os.getenv("DISCORD_TOKEN")
 
+# --- Sharding e Clusters ---
+# Com CLUSTER_COUNT > 1 este processo vira um supervisor que sobe um processo por cluster,
+# cada um com uma faixa contígua de shards. CLUSTER_ID só é definido nos processos filhos.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None  # None: usa a quantidade recomendada pelo Discord
+CLUSTER_COUNT = max(1, int(os.getenv("CLUSTER_COUNT", "1")))
+CLUSTER_ID = int(os.environ["CLUSTER_ID"]) if os.getenv("CLUSTER_ID") else None
+IPC_HOST = "127.0.0.1"
+IPC_PORT = int(os.getenv("IPC_PORT", "8765"))
+IPC_TIMEOUT = 30
+CLUSTER_RESTART_DELAY = 5   # Segundos; dobra a cada queda seguida, até CLUSTER_RESTART_MAX_DELAY
+CLUSTER_RESTART_MAX_DELAY = 300
+CLUSTER_STABLE_AFTER = 60   # Um cluster que ficou de pé por esse tempo zera a contagem de quedas
+
+# Cada cluster escreve no próprio arquivo: vários processos no mesmo RotatingFileHandler corrompem a rotação.
+LOG_FILE = f"discord_bot.cluster{CLUSTER_ID}.log" if CLUSTER_ID is not None else "discord_bot.log"
+LOG_BACKUP_COUNT = 5
+
 # --- Sistema de Logs Profissional ---
+# Quem loga (event loop, thread de áudio) só coloca o registro numa fila; a escrita em arquivo/console,
+# inclusive a rotação, acontece numa thread dedicada do QueueListener.
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"              # Console em JSON, uma linha por registro (para coletores de log)
+LOG_TRACK_SAMPLE = max(1, int(os.getenv("LOG_TRACK_SAMPLE", "10")))  # Mensagens por música: registra 1 a cada N
+LOG_CONTEXT_FIELDS = ('guild_id', 'command', 'latency_ms')
+
 # Cria um logger principal para o bot.
 logger = logging.getLogger('discord_bot')
 logger.setLevel(logging.INFO) # Define o nível mínimo de logs a serem capturados
 
-# Formato do log: Data/Hora, Nível do Log, Nome do Módulo, Mensagem
-log_format = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
-
-# Handler para salvar os logs em um arquivo com rotação automática
-# Cria um novo arquivo quando o atual atinge 10MB, mantendo até 5 arquivos antigos.
-file_handler = logging.handlers.RotatingFileHandler(
-    filename='discord_bot.log',
-    encoding='utf-8',
-    maxBytes=10 * 1024 * 1024,  # 10 MB
-    backupCount=5,
-)
-file_handler.setFormatter(log_format)
-
-# Handler para mostrar os logs no console (terminal)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_format)
-
-# Adiciona os handlers ao logger principal
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+class ContextFormatter(logging.Formatter):
+    """Formato texto; os campos de contexto (servidor, comando, latência) entram antes da mensagem."""
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        context = ' '.join(f"{field}={getattr(record, field)}" for field in LOG_CONTEXT_FIELDS if getattr(record, field, None) is not None)
+        record.context = f"[{context}] " if context else ""
+        return super().formatMessage(record)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        for field in LOG_CONTEXT_FIELDS:
+            if getattr(record, field, None) is not None: payload[field] = getattr(record, field)
+        return json.dumps(payload, ensure_ascii=False)
+
+class TrackSampler(logging.Filter):
+    """Deixa passar 1 a cada N registros marcados com extra={'sampled': True}; avisos e erros sempre passam."""
+    def __init__(self, every: int):
+        super().__init__(); self.every = every; self.counts: Dict[tuple, int] = {}
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'sampled', False) or record.levelno >= logging.WARNING or self.every <= 1: return True
+        key = (record.name, record.lineno) # A mesma linha de código é a mesma mensagem, com outra música
+        count = self.counts.get(key, 0); self.counts[key] = count + 1
+        return count % self.every == 0
+
+def start_logging():
+    """Liga os handlers do logger principal; só o processo do bot (ou do supervisor) chama, nunca os workers."""
+    # Formato do log: Data/Hora, Nível do Log, Nome do Módulo, Mensagem
+    log_format = ContextFormatter('%(asctime)s:%(levelname)s:%(name)s: %(context)s%(message)s')
+
+    # Handler para salvar os logs em um arquivo com rotação automática
+    # Cria um novo arquivo quando o atual atinge 10MB, mantendo até 5 arquivos antigos.
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename=LOG_FILE,
+        encoding='utf-8',
+        maxBytes=10 * 1024 * 1024,  # 10 MB
+        backupCount=LOG_BACKUP_COUNT,
+    )
+    file_handler.setFormatter(log_format) # O arquivo fica sempre em texto: é o que o !log lê
+
+    # Handler para mostrar os logs no console (terminal)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(JsonFormatter() if LOG_JSON else log_format)
+
+    # O logger principal só enfileira; o listener repassa para os handlers reais na thread dele.
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TrackSampler(LOG_TRACK_SAMPLE))
+    logger.addHandler(queue_handler)
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop) # Esvazia a fila antes de sair
 # --- Fim do Sistema de Logs ---
 
 # Define as intenções (Intents) do bot, permissões necessárias para ele funcionar
@@ -45,11 +109,146 @@ intents = discord.Intents.default()
 intents.message_content = True  # Para ler comandos de texto como !pl
 intents.voice_states = True     # Para gerenciar estados de voz (entrar/sair de canais)
 
-class MusicBot(commands.Bot):
+def cluster_shards(cluster_id: int, clusters: int, shards: int) -> list:
+    """Faixa contígua de shards de um cluster; os tamanhos diferem em no máximo 1 e nenhuma fica vazia."""
+    # Uma faixa vazia viraria shard_ids=[], e o discord.py conectaria todos os shards nesse cluster.
+    return list(range(shards * cluster_id // clusters, shards * (cluster_id + 1) // clusters))
+
+def cluster_for_guild(guild_id: int, clusters: int, shards: int) -> int:
+    # Fórmula de shard do Discord: (guild_id >> 22) % shard_count; o inverso da divisão de cluster_shards.
+    shard_id = (guild_id >> 22) % shards
+    return ((shard_id + 1) * clusters - 1) // shards
+
+async def fetch_recommended_shards() -> int:
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {BOT_TOKEN}"}) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+class ClusterLink:
+    """Conexão de um cluster com o supervisor: envia pedidos a outros clusters e atende os recebidos.
+
+    Protocolo: uma mensagem JSON por linha; o supervisor só repassa pelo campo 'target'/'id'.
+    """
+    def __init__(self, cluster_id: int):
+        self.cluster_id = cluster_id
+        self.handlers: Dict[str, callable] = {}
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self): self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_connection(IPC_HOST, IPC_PORT)
+                await self._send({'op': 'hello', 'cluster': self.cluster_id})
+                logger.info(f"Cluster {self.cluster_id} conectado ao supervisor.")
+                while line := await reader.readline(): asyncio.create_task(self._dispatch(json.loads(line)))
+            except (OSError, json.JSONDecodeError) as e: logger.warning(f"Conexão IPC do cluster {self.cluster_id} falhou: {e}")
+            self.writer = None
+            for future in self.pending.values():
+                if not future.done(): future.set_exception(ConnectionError("conexão com o supervisor perdida"))
+            self.pending.clear()
+            await asyncio.sleep(CLUSTER_RESTART_DELAY)
+
+    async def _send(self, message: dict):
+        if not self.writer: raise ConnectionError("sem conexão com o supervisor")
+        self.writer.write(json.dumps(message).encode() + b"\n"); await self.writer.drain()
+
+    async def _dispatch(self, message: dict):
+        if message['op'] == 'response':
+            future = self.pending.pop(message['id'], None)
+            if future and not future.done():
+                if message.get('error'): future.set_exception(RuntimeError(message['error']))
+                else: future.set_result(message.get('result'))
+        elif message['op'] == 'request':
+            response = {'op': 'response', 'id': message['id']}
+            try: response['result'] = await self.handlers[message['command']](**message.get('args', {}))
+            except Exception as e: response['error'] = f"{type(e).__name__}: {e}"
+            await self._send(response)
+
+    async def request(self, target: int, command: str, **args):
+        """Executa `command` no cluster `target` e devolve o resultado."""
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future(); self.pending[request_id] = future
+        try:
+            await self._send({'op': 'request', 'id': request_id, 'target': target, 'command': command, 'args': args})
+            return await asyncio.wait_for(future, IPC_TIMEOUT)
+        finally: self.pending.pop(request_id, None)
+
+class ClusterSupervisor:
+    """Sobe um processo por cluster, reinicia os que caírem e roteia o IPC entre eles."""
+    def __init__(self, clusters: int, shards: int):
+        self.clusters = clusters; self.shards = shards
+        self.processes: Dict[int, asyncio.subprocess.Process] = {}
+        self.links: Dict[int, asyncio.StreamWriter] = {}
+        self.pending: Dict[str, asyncio.StreamWriter] = {} # id do pedido -> cluster que perguntou
+
+    async def run(self):
+        server = await asyncio.start_server(self._handle_link, IPC_HOST, IPC_PORT)
+        logger.info(f"Supervisor iniciado: {self.clusters} clusters, {self.shards} shards.")
+        try:
+            async with server: await asyncio.gather(*(self._keep_alive(cluster_id) for cluster_id in range(self.clusters)))
+        finally:
+            for process in self.processes.values():
+                if process.returncode is None: process.terminate()
+
+    async def _keep_alive(self, cluster_id: int):
+        failures = 0
+        while True:
+            env = dict(os.environ, CLUSTER_ID=str(cluster_id), CLUSTER_COUNT=str(self.clusters), SHARD_COUNT=str(self.shards))
+            started = time.monotonic()
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self.processes[cluster_id] = process
+            logger.info(f"Cluster {cluster_id} iniciado (PID {process.pid}, shards {cluster_shards(cluster_id, self.clusters, self.shards)}).")
+            code = await process.wait()
+            if code == 0:
+                logger.info(f"Cluster {cluster_id} encerrado normalmente."); return
+            failures = 0 if time.monotonic() - started > CLUSTER_STABLE_AFTER else failures + 1
+            delay = min(CLUSTER_RESTART_DELAY * 2 ** failures, CLUSTER_RESTART_MAX_DELAY)
+            logger.error(f"Cluster {cluster_id} caiu com código {code}. Reiniciando em {delay}s.")
+            await asyncio.sleep(delay)
+
+    async def _handle_link(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        cluster_id = None
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message['op'] == 'hello':
+                    cluster_id = message['cluster']; self.links[cluster_id] = writer
+                elif message['op'] == 'request':
+                    target = self.links.get(message['target'])
+                    if target: self.pending[message['id']] = writer; await self._forward(target, message)
+                    else: await self._forward(writer, {'op': 'response', 'id': message['id'], 'error': f"cluster {message['target']} indisponível"})
+                elif message['op'] == 'response':
+                    origin = self.pending.pop(message['id'], None)
+                    if origin: await self._forward(origin, message)
+        except (OSError, json.JSONDecodeError) as e: logger.warning(f"Conexão IPC do cluster {cluster_id} caiu: {e}")
+        finally:
+            if self.links.get(cluster_id) is writer: del self.links[cluster_id]
+            writer.close()
+
+    async def _forward(self, writer: asyncio.StreamWriter, message: dict):
+        try:
+            writer.write(json.dumps(message).encode() + b"\n"); await writer.drain()
+        except OSError as e: logger.warning(f"Falha ao repassar mensagem IPC: {e}")
+
+class MusicBot(commands.AutoShardedBot):
     """Classe principal do Bot para uma melhor organização e escalabilidade."""
     def __init__(self):
+        # Em modo cluster, cada processo conecta só os próprios shards.
+        shard_ids = cluster_shards(CLUSTER_ID, CLUSTER_COUNT, SHARD_COUNT) if CLUSTER_ID is not None else None
         # O prefixo '!' é usado para comandos de texto
-        super().__init__(command_prefix="!", intents=intents)
+        super().__init__(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=shard_ids)
+        self.cluster_id = CLUSTER_ID
+        self.ipc: Optional[ClusterLink] = None
+
+    def cluster_for_guild(self, guild_id: int) -> Optional[int]:
+        if self.cluster_id is None: return None
+        return cluster_for_guild(guild_id, CLUSTER_COUNT, SHARD_COUNT)
 
     async def setup_hook(self):
         """
@@ -63,51 +262,81 @@ class MusicBot(commands.Bot):
         await self.load_extension("cogs.moderation_cog")
         logger.info("Cog de moderação carregado com sucesso.")
 
-# Cria a instância principal do bot
-bot = MusicBot()
+        if self.cluster_id is not None:
+            self.ipc = ClusterLink(self.cluster_id)
+            self.ipc.handlers.update({'sync': ipc_sync, 'log': ipc_log})
+            self.ipc.start()
+
+# Instância principal do bot, criada em main(). Este módulo é importado de novo pelos workers de extração
+# (forkserver), então nada aqui em cima pode abrir arquivos de log, subir threads ou criar o bot.
+bot: Optional[MusicBot] = None
 
-@bot.event
 async def on_ready():
     """Evento disparado quando o bot está online e pronto para uso."""
-    logger.info(f'Bot {bot.user.name} está online e pronto.')
+    cluster = f" (cluster {bot.cluster_id})" if bot.cluster_id is not None else ""
+    logger.info(f'Bot {bot.user.name} está online e pronto{cluster}. Shards: {sorted(bot.shards)}.')
     logger.info(f'Use !sync para gerenciar os comandos de barra.')
 
 # --- Comandos de Sincronização (Apenas para o Dono do Bot) ---
-@bot.command()
+async def sync_tree(guild: Optional[discord.Guild], clear: bool = False) -> int:
+    """Sincroniza (ou limpa) os comandos de barra, globalmente ou de um servidor."""
+    if clear: bot.tree.clear_commands(guild=guild)
+    elif guild: bot.tree.copy_global_to(guild=guild)
+    return len(await bot.tree.sync(guild=guild))
+
+async def ipc_sync(guild_id: int, clear: bool = False) -> dict:
+    guild = bot.get_guild(guild_id)
+    if not guild: raise LookupError(f"servidor {guild_id} não está neste cluster")
+    return {'count': await sync_tree(guild, clear), 'name': guild.name}
+
+async def sync_remote_guild(ctx: commands.Context, guild_id: int, clear: bool = False) -> Optional[dict]:
+    # Um ID que não foi encontrado aqui pode ser de um servidor atendido por outro cluster.
+    if not bot.ipc:
+        await ctx.send(f"Servidor `{guild_id}` não encontrado."); return None
+    target = bot.cluster_for_guild(guild_id)
+    try: return await bot.ipc.request(target, 'sync', guild_id=guild_id, clear=clear)
+    except Exception as e:
+        await ctx.send(f"Falha ao sincronizar pelo cluster {target}: {e}"); return None
+
+@commands.command()
 @commands.is_owner()
-async def sync(ctx: commands.Context, guild: Optional[discord.Guild] = None):
+async def sync(ctx: commands.Context, guild: Optional[Union[discord.Guild, int]] = None):
     """
     Sincroniza os comandos de barra com o Discord.
-    Pode ser global ou para um servidor específico.
+    Pode ser global ou para um servidor específico (inclusive de outro cluster, pelo ID).
     """
-    if guild:
-        bot.tree.copy_global_to(guild=guild)
-        synced = await bot.tree.sync(guild=guild)
-        await ctx.send(f"Sincronizados {len(synced)} comandos para o servidor `{guild.name}`.")
+    if isinstance(guild, int):
+        result = await sync_remote_guild(ctx, guild)
+        if not result: return
+        await ctx.send(f"Sincronizados {result['count']} comandos para o servidor `{result['name']}`.")
+        logger.info(f"Comandos sincronizados para o servidor '{result['name']}' por '{ctx.author.name}'.")
+    elif guild:
+        synced = await sync_tree(guild)
+        await ctx.send(f"Sincronizados {synced} comandos para o servidor `{guild.name}`.")
         logger.info(f"Comandos sincronizados para o servidor '{guild.name}' por '{ctx.author.name}'.")
     else:
-        synced = await bot.tree.sync()
-        await ctx.send(f"Sincronizados {len(synced)} comandos globalmente.")
+        synced = await sync_tree(None)
+        await ctx.send(f"Sincronizados {synced} comandos globalmente.")
         logger.info(f"Comandos sincronizados globalmente por '{ctx.author.name}'.")
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
-async def unsync(ctx: commands.Context, guild: Optional[discord.Guild] = None):
+async def unsync(ctx: commands.Context, guild: Optional[Union[discord.Guild, int]] = None):
     """Remove os comandos de barra do Discord."""
-    bot.tree.clear_commands(guild=guild)
-    await bot.tree.sync(guild=guild)
+    if isinstance(guild, int):
+        if not await sync_remote_guild(ctx, guild, clear=True): return
+    else: await sync_tree(guild, clear=True)
     await ctx.send(f"Comandos de barra removidos.")
     logger.warning(f"Comandos de barra removidos por '{ctx.author.name}'.")
 
-@bot.command()
+@commands.command()
 @commands.is_owner()
-async def resync(ctx: commands.Context, guild: Optional[discord.Guild] = None):
+async def resync(ctx: commands.Context, guild: Optional[Union[discord.Guild, int]] = None):
     """Executa um unsync seguido de um sync para forçar a atualização."""
     await unsync(ctx, guild)
     await sync(ctx, guild)
 
 # --- Tratamento de Erros de Comando ---
-@bot.event
 async def on_command_error(ctx: commands.Context, error):
     """Tratador de erros global para comandos de texto."""
     if isinstance(error, commands.CommandNotFound):
@@ -120,35 +349,149 @@ async def on_command_error(ctx: commands.Context, error):
         logger.error(f"Erro ao executar o comando '{ctx.command}': {error}", exc_info=error)
         await ctx.send("Ocorreu um erro ao executar este comando. Verifique os logs para mais detalhes.")
 
+# --- Métricas de Comandos ---
+async def mark_command_start(ctx: commands.Context):
+    ctx.started_at = time.perf_counter()
+
+async def log_command_latency(ctx: commands.Context):
+    latency_ms = round((time.perf_counter() - getattr(ctx, 'started_at', time.perf_counter())) * 1000)
+    logger.info(f"Comando !{ctx.command} executado por '{ctx.author.name}'.",
+                extra={'guild_id': ctx.guild.id if ctx.guild else None, 'command': ctx.command.qualified_name, 'latency_ms': latency_ms})
+
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    # Latência de ponta a ponta: da criação da interação no Discord até o fim do comando.
+    latency_ms = round((discord.utils.utcnow() - interaction.created_at).total_seconds() * 1000)
+    logger.info(f"Comando /{command.qualified_name} executado por '{interaction.user.name}'.",
+                extra={'guild_id': interaction.guild_id, 'command': command.qualified_name, 'latency_ms': latency_ms})
+
 # --- Comando de Log (Apenas para o Dono do Bot) ---
-@bot.command()
+LOG_TAIL_BLOCK = 64 * 1024 # Bytes lidos por vez, de trás para frente
+LOG_TAIL_MAX = 5000        # Máximo de entradas por consulta
+# Cabeçalho de uma entrada no formato do log_format: "2024-01-31 12:00:00,123:INFO:discord_bot.music_cog: ..."
+LOG_ENTRY_REGEX = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+:([A-Z]+):([^:]+): ')
+
+def reverse_lines(path: str):
+    """Linhas de um arquivo da última para a primeira, lendo só os blocos necessários."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END); position = f.tell(); remainder = b''
+        while position > 0:
+            size = min(LOG_TAIL_BLOCK, position); position -= size
+            f.seek(position); lines = (f.read(size) + remainder).split(b'\n')
+            remainder = lines.pop(0) # Pode ter começado no bloco anterior
+            for line in reversed(lines): yield line.decode('utf-8', errors='replace').rstrip('\r')
+        yield remainder.decode('utf-8', errors='replace').rstrip('\r')
+
+def parse_log_time(value: Optional[str]) -> Optional[datetime]:
+    """Aceita '30m', '2h', '1d' (relativo a agora), 'HH:MM' (hoje) ou 'AAAA-MM-DD [HH:MM[:SS]]'."""
+    if not value: return None
+    value = value.strip()
+    relative = re.fullmatch(r'(\d+)([mhd])', value)
+    if relative:
+        amount = int(relative.group(1)); unit = {'m': 'minutes', 'h': 'hours', 'd': 'days'}[relative.group(2)]
+        return datetime.now() - timedelta(**{unit: amount})
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try: return datetime.strptime(value, fmt)
+        except ValueError: pass
+    try: return datetime.combine(datetime.now().date(), datetime.strptime(value, "%H:%M").time())
+    except ValueError: raise ValueError(f"horário inválido: '{value}'")
+
+def parse_log_level(value: Optional[str]) -> Optional[int]:
+    if not value: return None
+    level = logging.getLevelName(value.upper())
+    if not isinstance(level, int): raise ValueError(f"nível inválido: '{value}'")
+    return level
+
+def read_log_tail(lines: int, level: Optional[str] = None, logger_name: Optional[str] = None,
+                  since: Optional[str] = None, until: Optional[str] = None) -> Optional[str]:
+    """Últimas `lines` entradas do log que passam nos filtros, percorrendo também os arquivos rotacionados.
+
+    Entradas com várias linhas (tracebacks) contam como uma só. A leitura para assim que junta
+    entradas suficientes ou passa do início do intervalo de tempo.
+    """
+    files = [path for path in [LOG_FILE] + [f"{LOG_FILE}.{i}" for i in range(1, LOG_BACKUP_COUNT + 1)] if os.path.exists(path)]
+    if not files: return None
+    min_level = parse_log_level(level); since_dt = parse_log_time(since); until_dt = parse_log_time(until)
+    lines = max(1, min(lines, LOG_TAIL_MAX)); entries = []
+    def collect():
+        continuation = []
+        for path in files: # Do mais novo para o mais antigo
+            for line in reverse_lines(path):
+                if not line: continue
+                match = LOG_ENTRY_REGEX.match(line)
+                if not match: continuation.append(line); continue
+                entry = "\n".join([line] + continuation[::-1]); continuation = []
+                timestamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+                if since_dt and timestamp < since_dt: return
+                if until_dt and timestamp > until_dt: continue
+                if min_level and logging.getLevelName(match.group(2)) < min_level: continue
+                if logger_name and logger_name not in match.group(3): continue
+                entries.append(entry)
+                if len(entries) >= lines: return
+    collect()
+    return "\n".join(reversed(entries))
+
+class LogFilters(commands.FlagConverter, prefix='--', delimiter=' '):
+    level: Optional[str] = None
+    logger: Optional[str] = None
+    since: Optional[str] = None
+    until: Optional[str] = None
+
+async def ipc_log(lines: int = 25, **filters) -> Optional[str]:
+    return await asyncio.get_running_loop().run_in_executor(None, lambda: read_log_tail(lines, **filters))
+
+@commands.command()
 @commands.is_owner()
-async def log(ctx: commands.Context, lines: int = 25):
-    """Mostra as últimas N linhas do arquivo de log."""
-    log_file = 'discord_bot.log'
-    if not os.path.exists(log_file):
+async def log(ctx: commands.Context, lines: Optional[int] = None, cluster: Optional[int] = None, *, filtros: LogFilters):
+    """
+    Mostra as últimas N entradas do log (de outro cluster, se informado).
+    Filtros: --level WARNING --logger music_cog --since 2h --until 2024-01-31 18:00
+    """
+    lines = lines or 25 # Optional para que '!log --level WARNING' não quebre tentando converter a flag em número
+    filters = {'level': filtros.level, 'logger_name': filtros.logger, 'since': filtros.since, 'until': filtros.until}
+    try:
+        parse_log_level(filtros.level); parse_log_time(filtros.since); parse_log_time(filtros.until)
+    except ValueError as e: return await ctx.send(f"Filtro inválido: {e}")
+    if cluster is not None and cluster != bot.cluster_id:
+        if not bot.ipc: return await ctx.send("O bot não está rodando em modo cluster.")
+        try: last_lines = await bot.ipc.request(cluster, 'log', lines=lines, **filters)
+        except Exception as e: return await ctx.send(f"Falha ao buscar o log do cluster {cluster}: {e}")
+    else: last_lines = await ipc_log(lines, **filters)
+    if last_lines is None:
         return await ctx.send("Arquivo de log não encontrado.")
-    
-    with open(log_file, 'r', encoding='utf-8') as f:
-        log_content = f.readlines()
-    
-    last_lines = "".join(log_content[-lines:])
+    if not last_lines:
+        return await ctx.send("Nenhuma entrada encontrada com esses filtros.")
     
     if len(last_lines) > 1990:
-        # Se for muito grande, envia como arquivo para não exceder o limite do Discord
-        with open("log_export.txt", "w", encoding="utf-8") as f:
-            f.write(last_lines)
-        await ctx.send("O log é muito grande. Enviando como arquivo.", file=discord.File("log_export.txt"))
-        os.remove("log_export.txt")
+        # Se for muito grande, envia como arquivo (direto da memória) para não exceder o limite do Discord
+        buffer = io.BytesIO(last_lines.encode('utf-8'))
+        await ctx.send("O log é muito grande. Enviando como arquivo.", file=discord.File(buffer, filename="log_export.txt"))
     else:
         await ctx.send(f"```\n{last_lines}\n```")
 
 # --- Ponto de Entrada Principal ---
-if __name__ == "__main__":
+def main():
+    global bot
+    start_logging()
     if not BOT_TOKEN:
         logger.critical("O TOKEN do Discord não foi encontrado! Verifique seu arquivo .env e se o nome é DISCORD_TOKEN.")
+    elif CLUSTER_COUNT > 1 and CLUSTER_ID is None:
+        # Processo supervisor: não conecta ao Discord, só gerencia os clusters.
+        async def supervise():
+            shards = SHARD_COUNT or max(CLUSTER_COUNT, await fetch_recommended_shards())
+            if CLUSTER_COUNT > shards:
+                return logger.critical(f"CLUSTER_COUNT ({CLUSTER_COUNT}) maior que SHARD_COUNT ({shards}): algum cluster ficaria sem shards.")
+            await ClusterSupervisor(CLUSTER_COUNT, shards).run()
+        try: asyncio.run(supervise())
+        except KeyboardInterrupt: logger.info("Supervisor encerrado.")
     else:
+        bot = MusicBot()
+        for command in (sync, unsync, resync, log): bot.add_command(command)
+        for event in (on_ready, on_command_error, on_app_command_completion): bot.event(event)
+        bot.before_invoke(mark_command_start); bot.after_invoke(log_command_latency)
         # Inicia o bot. O log_handler=None impede que a biblioteca discord.py configure seu próprio logger.
         # Nós já configuramos o nosso, que é mais completo.
         bot.run(BOT_TOKEN, log_handler=None)
 
+if __name__ == "__main__":
+    main()
+
@@ -2,7 +2,13 @@
 
 import os
 import json
+import time
+import sqlite3
+import threading
+import heapq
+import asyncio
 import logging
+from typing import Dict, List, Optional, Tuple
 import discord
 from discord import ui
 from discord.ext import commands
@@ -11,9 +17,68 @@ from datetime import datetime, timedelta
 # Pega o logger configurado no bot.py
 logger = logging.getLogger('discord_bot.moderation_cog')
 
-# Nome do arquivo para persistir os bans
+# Banco para persistir os bans; o banlist.json antigo é importado uma única vez
+BANS_DB_FILE = "bans.db"
 BANLIST_FILE = "banlist.json"
 ITEMS_PER_PAGE = 4 # Usuários por página no menu
+SAVE_DELAY = 2.0 # Segundos agrupando alterações antes de gravar no banco (write-behind)
+USER_NAME_TTL = 600 # Segundos que um nome resolvido fica em cache para o menu de moderação
+GLOBAL_GUILD_ID = 0 # Bans antigos, de antes dos bans por servidor: continuam valendo em todos
+
+class BanStore:
+    """Banlist em SQLite (WAL), uma linha por (servidor, usuário); cada lote é uma transação atômica.
+
+    Um crash no meio de uma gravação perde no máximo o lote em andamento, nunca a lista inteira.
+    """
+    def __init__(self, path: str = BANS_DB_FILE):
+        # As gravações rodam em threads do executor; o lock garante uma por vez na mesma conexão.
+        self.db = sqlite3.connect(path, check_same_thread=False); self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL"); self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS guild_bans (guild_id INTEGER NOT NULL, member_id TEXT NOT NULL, until TEXT, "
+                        "banned_by INTEGER, reason TEXT, PRIMARY KEY (guild_id, member_id))")
+        self.db.commit()
+        self._migrate_global_table(); self._migrate_json()
+
+    def _migrate_global_table(self):
+        # A tabela 'bans' (sem servidor) vira bans globais na tabela nova.
+        if not self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bans'").fetchone(): return
+        try:
+            with self.lock, self.db:
+                self.db.execute("INSERT OR IGNORE INTO guild_bans SELECT ?, member_id, until, banned_by, reason FROM bans", (GLOBAL_GUILD_ID,))
+                self.db.execute("DROP TABLE bans")
+        except sqlite3.OperationalError: return # Outro cluster migrou (e apagou a tabela) primeiro
+        logger.info("Bans antigos migrados para bans globais por servidor.")
+
+    def _migrate_json(self):
+        if not os.path.exists(BANLIST_FILE) or self.db.execute("SELECT 1 FROM guild_bans LIMIT 1").fetchone(): return
+        # Com clusters, todos os processos tentam a migração ao mesmo tempo: quem chegar depois não acha o arquivo.
+        try:
+            with open(BANLIST_FILE, 'r', encoding='utf-8') as f: bans = json.load(f)
+        except FileNotFoundError: return
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"Não foi possível importar {BANLIST_FILE}: {e}. O arquivo foi mantido para recuperação manual."); return
+        self.apply({(GLOBAL_GUILD_ID, member_id_str): ban_info for member_id_str, ban_info in bans.items()})
+        try: os.replace(BANLIST_FILE, BANLIST_FILE + ".migrated")
+        except FileNotFoundError: return # Importação idempotente (INSERT OR REPLACE): o outro cluster já renomeou
+        logger.info(f"{len(bans)} bans importados de {BANLIST_FILE} para {BANS_DB_FILE}.")
+
+    def load(self) -> Dict[int, Dict[str, dict]]:
+        bans: Dict[int, Dict[str, dict]] = {}
+        for guild_id, member_id, until, banned_by, reason in self.db.execute("SELECT guild_id, member_id, until, banned_by, reason FROM guild_bans"):
+            bans.setdefault(guild_id, {})[member_id] = {"until": until, "banned_by": banned_by, "reason": reason}
+        return bans
+
+    def apply(self, changes: Dict[Tuple[int, str], Optional[dict]], cleared_guilds: frozenset = frozenset()):
+        """Grava um lote: `None` remove o ban; os servidores em `cleared_guilds` são esvaziados antes do lote."""
+        with self.lock, self.db:
+            for guild_id in cleared_guilds: self.db.execute("DELETE FROM guild_bans WHERE guild_id = ?", (guild_id,))
+            for (guild_id, member_id_str), ban_info in changes.items():
+                if ban_info is None: self.db.execute("DELETE FROM guild_bans WHERE guild_id = ? AND member_id = ?", (guild_id, member_id_str))
+                else: self.db.execute("INSERT OR REPLACE INTO guild_bans VALUES (?, ?, ?, ?, ?)",
+                                      (guild_id, member_id_str, ban_info.get("until"), ban_info.get("banned_by"), ban_info.get("reason")))
+
+    def close(self):
+        with self.lock: self.db.close()
 
 class ConfirmMassUnban(ui.View):
     """View de confirmação para a ação de desbanir todos."""
@@ -41,11 +106,12 @@ class ConfirmMassUnban(ui.View):
 
 class ModerationMenu(ui.View):
     """View interativa para gerenciar a lista de banidos."""
-    def __init__(self, author: discord.Member, bans: dict, cog: "ModerationCog", page: int = 0):
+    def __init__(self, author: discord.Member, bans: list, cog: "ModerationCog", page: int = 0):
         super().__init__(timeout=180)
         self.author = author
         self.cog = cog
-        self.all_bans = list(bans.items())
+        self.guild_id = author.guild.id
+        self.all_bans = bans
         self.page = page
         self.total_pages = max(0, (len(self.all_bans) - 1) // ITEMS_PER_PAGE)
         self.update_view_items()
@@ -70,12 +136,11 @@ class ModerationMenu(ui.View):
 
         description = ""
         now = datetime.utcnow()
+        names = await self.cog.resolve_user_names([int(member_id_str) for member_id_str, _ in page_bans], getattr(self.author, 'guild', None))
         for i, (member_id_str, ban_info) in enumerate(page_bans):
-            try:
-                member = await self.cog.bot.fetch_user(int(member_id_str))
-                member_display = f"{member.name} (`{member.id}`)"
-            except discord.NotFound:
-                member_display = f"ID: `{member_id_str}` (usuário desconhecido)"
+            name = names.get(int(member_id_str))
+            if name: member_display = f"{name} (`{member_id_str}`)"
+            else: member_display = f"ID: `{member_id_str}` (usuário desconhecido)"
             
             until = ban_info.get("until")
             reason = ban_info.get("reason", "Nenhum motivo fornecido.") # [NOVO] Pega o motivo
@@ -93,6 +158,9 @@ class ModerationMenu(ui.View):
             description += f"**{i + 1 + start_index}. {member_display}**\n- **Motivo:** *{reason}*\n- {ban_status}\n\n"
 
         embed.description = description
+        # Bans globais antigos continuam valendo aqui, mas não entram na lista: só o dono do bot pode removê-los.
+        legacy_count = len(self.cog.bans.get(GLOBAL_GUILD_ID, {}))
+        if legacy_count: embed.set_footer(text=f"{legacy_count} ban(s) global(is) antigo(s) também vale(m) neste servidor (somente leitura).")
         return embed
 
     def update_view_items(self):
@@ -135,10 +203,8 @@ class ModerationMenu(ui.View):
         await interaction.response.defer()
         member_id_str = interaction.data['custom_id'].split('_')[1]
 
-        if member_id_str in self.cog.bans:
-            del self.cog.bans[member_id_str]
-            self.cog._save_bans()
-            self.all_bans = list(self.cog.bans.items())
+        if self.cog.remove_ban(self.guild_id, member_id_str):
+            self.all_bans = self.cog.guild_bans(self.guild_id)
             await self.refresh_menu(interaction)
         else:
             await interaction.followup.send("Este usuário não estava mais na lista.", ephemeral=True, delete_after=5)
@@ -160,8 +226,7 @@ class ModerationMenu(ui.View):
         await confirm_view.wait()
 
         if confirm_view.confirmed:
-            self.cog.bans.clear()
-            self.cog._save_bans()
+            self.cog.clear_bans(self.guild_id)
             self.all_bans = []
             await interaction.followup.send("💥 Todos os usuários foram desbanidos.", ephemeral=True)
             await self.refresh_menu(interaction)
@@ -172,24 +237,143 @@ class ModerationCog(commands.Cog, name="Moderation"):
     """Cog para gerenciar permissões de uso do bot."""
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.bans = self._load_bans()
-
-    def _load_bans(self) -> dict:
-        if os.path.exists(BANLIST_FILE):
-            try:
-                with open(BANLIST_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                logger.error(f"Erro ao carregar {BANLIST_FILE}: {e}. Criando um novo arquivo.")
-                return {}
-        return {}
-
-    def _save_bans(self):
-        try:
-            with open(BANLIST_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.bans, f, indent=4)
-        except IOError as e:
-            logger.error(f"Não foi possível salvar a banlist em {BANLIST_FILE}: {e}")
+        # Índice em memória por servidor: é a fonte da verdade, o disco só recebe as alterações (write-behind).
+        self.store = BanStore()
+        self.bans: Dict[int, Dict[str, dict]] = self.store.load()
+        self._expiry_heap: List[Tuple[datetime, int, str, str]] = [] # (vencimento, servidor, usuário, 'until')
+        self._expiry_changed = asyncio.Event()
+        self._save_task: Optional[asyncio.Task] = None
+        self._pending: Dict[Tuple[int, str], Optional[dict]] = {}; self._pending_clear: set = set() # Alterações ainda não gravadas
+        self._rebuild_expiry_heap()
+        self._user_names: Dict[int, Tuple[Optional[str], float]] = {} # id -> (nome ou None se não existe, validade)
+        self._sweeper_task = self.bot.loop.create_task(self._expiry_sweeper())
+
+    def cog_unload(self):
+        # Garante que alterações pendentes não se percam ao descarregar o cog.
+        self._sweeper_task.cancel()
+        if self._save_task and not self._save_task.done(): self._save_task.cancel()
+        changes, cleared = self._take_pending()
+        if changes or cleared: self.store.apply(changes, cleared)
+        self.store.close()
+
+    def _take_pending(self) -> Tuple[Dict[Tuple[int, str], Optional[dict]], frozenset]:
+        changes, cleared = self._pending, frozenset(self._pending_clear)
+        self._pending = {}; self._pending_clear = set()
+        return changes, cleared
+
+    async def _flush_bans_later(self):
+        """Agrupa as alterações feitas em SAVE_DELAY segundos e grava o lote fora do event loop."""
+        while self._pending or self._pending_clear:
+            await asyncio.sleep(SAVE_DELAY)
+            changes, cleared = self._take_pending()
+            try: await self.bot.loop.run_in_executor(None, self.store.apply, changes, cleared)
+            except sqlite3.Error as e:
+                logger.error(f"Não foi possível salvar a banlist em {BANS_DB_FILE}: {e}. Tentando de novo.")
+                # Devolve o lote à fila sem sobrescrever alterações mais novas.
+                for key, ban_info in changes.items():
+                    if key not in self._pending and key[0] not in self._pending_clear: self._pending[key] = ban_info
+                self._pending_clear |= cleared
+
+    def _queue_write(self, guild_id: int, member_id_str: Optional[str] = None, ban_info: Optional[dict] = None):
+        # Várias alterações no mesmo usuário viram uma só linha no lote; sem usuário, o lote esvazia o servidor.
+        if member_id_str is None:
+            self._pending = {key: value for key, value in self._pending.items() if key[0] != guild_id}; self._pending_clear.add(guild_id)
+        else: self._pending[(guild_id, member_id_str)] = ban_info
+        if not self._save_task or self._save_task.done():
+            self._save_task = self.bot.loop.create_task(self._flush_bans_later())
+
+    # --- Índice de Bans ---
+    def _rebuild_expiry_heap(self):
+        self._expiry_heap = []
+        for guild_id, guild_bans in self.bans.items():
+            for member_id_str, ban_info in guild_bans.items():
+                self._push_expiry(guild_id, member_id_str, ban_info)
+
+    def _push_expiry(self, guild_id: int, member_id_str: str, ban_info: dict):
+        until = ban_info.get("until")
+        if until:
+            entry = (datetime.fromisoformat(until), guild_id, member_id_str, until)
+            heapq.heappush(self._expiry_heap, entry)
+            # Só acorda o sweeper se o próximo vencimento mudou.
+            if self._expiry_heap[0] is entry: self._expiry_changed.set()
+
+    def _purge_expired(self) -> int:
+        """Remove de uma vez todos os bans vencidos olhando apenas o topo do heap."""
+        now = datetime.utcnow(); removed = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, guild_id, member_id_str, until = heapq.heappop(self._expiry_heap)
+            ban_info = self.bans.get(guild_id, {}).get(member_id_str)
+            # Entradas antigas do heap (ban refeito ou removido) são simplesmente descartadas.
+            if ban_info and ban_info.get("until") == until:
+                self._discard(guild_id, member_id_str); removed += 1
+                logger.info(f"Ban de ({member_id_str}) no servidor {guild_id} expirou e foi removido.")
+        return removed
+
+    async def _expiry_sweeper(self):
+        """Dorme até o próximo vencimento do heap (ou até um ban novo vencer antes) e remove os vencidos em lote."""
+        while True:
+            self._expiry_changed.clear()
+            timeout = (self._expiry_heap[0][0] - datetime.utcnow()).total_seconds() if self._expiry_heap else None
+            if timeout is None or timeout > 0:
+                try: await asyncio.wait_for(self._expiry_changed.wait(), timeout)
+                except asyncio.TimeoutError: pass
+            self._purge_expired()
+
+    def _discard(self, guild_id: int, member_id_str: str):
+        guild_bans = self.bans[guild_id]
+        del guild_bans[member_id_str]
+        if not guild_bans: del self.bans[guild_id]
+        self._queue_write(guild_id, member_id_str)
+
+    def _active(self, guild_id: int, member_id_str: str) -> bool:
+        ban_info = self.bans.get(guild_id, {}).get(member_id_str)
+        if not ban_info: return False
+        # O sweeper pode estar alguns milissegundos atrasado: o vencimento é conferido aqui também.
+        until = ban_info.get("until")
+        return not until or datetime.fromisoformat(until) > datetime.utcnow()
+
+    def is_banned(self, guild_id: Optional[int], member_id: int) -> bool:
+        """Consulta O(1) ao índice em memória; nunca acessa o disco."""
+        member_id_str = str(member_id)
+        return (guild_id is not None and self._active(guild_id, member_id_str)) or self._active(GLOBAL_GUILD_ID, member_id_str)
+
+    def guild_bans(self, guild_id: int) -> List[Tuple[str, dict]]:
+        """Bans de um servidor para o menu, sem percorrer os outros servidores (os globais antigos ficam de fora)."""
+        return list(self.bans.get(guild_id, {}).items())
+
+    def add_ban(self, guild_id: int, member_id_str: str, ban_info: dict):
+        self.bans.setdefault(guild_id, {})[member_id_str] = ban_info
+        self._push_expiry(guild_id, member_id_str, ban_info)
+        self._queue_write(guild_id, member_id_str, ban_info)
+
+    def remove_ban(self, guild_id: int, member_id_str: str) -> bool:
+        # Só mexe no escopo pedido: bans globais antigos só saem pelo comando do dono (!globalunban).
+        if member_id_str not in self.bans.get(guild_id, {}): return False
+        self._discard(guild_id, member_id_str); return True
+
+    def clear_bans(self, guild_id: int):
+        if self.bans.pop(guild_id, None) is not None: self._queue_write(guild_id)
+        # As entradas do heap desse servidor ficam órfãs e são descartadas quando chegarem ao topo.
+
+    # --- Resolução de Usuários ---
+    async def resolve_user_names(self, user_ids: List[int], guild: Optional[discord.Guild] = None) -> Dict[int, Optional[str]]:
+        """Nomes dos usuários: cache com TTL, depois caches do cliente, e só o que faltar vai à API (em paralelo)."""
+        now = time.monotonic(); names: Dict[int, Optional[str]] = {}; missing: List[int] = []
+        for user_id in user_ids:
+            cached = self._user_names.get(user_id)
+            if cached and cached[1] > now: names[user_id] = cached[0]; continue
+            user = self.bot.get_user(user_id) or (guild.get_member(user_id) if guild else None)
+            if user: names[user_id] = user.name; self._user_names[user_id] = (user.name, now + USER_NAME_TTL)
+            else: missing.append(user_id)
+        results = await asyncio.gather(*(self.bot.fetch_user(user_id) for user_id in missing), return_exceptions=True)
+        for user_id, result in zip(missing, results):
+            if isinstance(result, discord.NotFound): names[user_id] = None
+            elif isinstance(result, Exception):
+                # Falha temporária da API: mostra como desconhecido, mas não guarda no cache.
+                logger.warning(f"Falha ao buscar o usuário {user_id}: {result}"); names[user_id] = None; continue
+            else: names[user_id] = result.name
+            self._user_names[user_id] = (names[user_id], now + USER_NAME_TTL)
+        return names
 
     @commands.command(name="ban", help="Proíbe um membro de usar os comandos de música. Uso: !ban @membro [minutos] [motivo]")
     @commands.has_permissions(manage_guild=True)
@@ -210,12 +394,11 @@ class ModerationCog(commands.Cog, name="Moderation"):
             duration_text = "**permanentemente**"
         
         # [NOVO] Salva o motivo junto com as outras informações
-        self.bans[member_id_str] = {
+        self.add_ban(ctx.guild.id, member_id_str, {
             "until": ban_until, 
             "banned_by": ctx.author.id,
             "reason": reason
-        }
-        self._save_bans()
+        })
         
         embed = discord.Embed(
             title="🚫 Usuário Banido",
@@ -232,9 +415,7 @@ class ModerationCog(commands.Cog, name="Moderation"):
     async def unban(self, ctx: commands.Context, member: discord.Member):
         member_id_str = str(member.id)
         
-        if member_id_str in self.bans:
-            del self.bans[member_id_str]
-            self._save_bans()
+        if self.remove_ban(ctx.guild.id, member_id_str):
             embed = discord.Embed(
                 title="✅ Usuário Desbanido",
                 description=f"{member.mention} agora pode usar os comandos de música novamente.",
@@ -242,17 +423,29 @@ class ModerationCog(commands.Cog, name="Moderation"):
             )
             await ctx.send(embed=embed)
             logger.info(f"'{member.display_name}' ({member.id}) foi desbanido por '{ctx.author.display_name}'.")
+        elif member_id_str in self.bans.get(GLOBAL_GUILD_ID, {}):
+            await ctx.send("Este membro tem um ban global antigo, que só o dono do bot pode remover.")
         else:
             await ctx.send("Este membro não está na lista de banidos.")
 
+    @commands.command(name="globalunban", help="Remove um ban global antigo (apenas para o dono do bot). Uso: !globalunban <id>")
+    @commands.is_owner()
+    async def globalunban(self, ctx: commands.Context, user: discord.User):
+        if self.remove_ban(GLOBAL_GUILD_ID, str(user.id)):
+            await ctx.send(f"✅ O ban global de {user.mention} foi removido.")
+            logger.info(f"Ban global de '{user.name}' ({user.id}) removido por '{ctx.author.name}'.")
+        else:
+            await ctx.send("Este usuário não tem um ban global.")
+
     @commands.command(name="mod", help="Abre o menu interativo de moderação.")
     @commands.has_permissions(manage_guild=True)
     async def mod(self, ctx: commands.Context):
-        self.bans = self._load_bans() # Recarrega para garantir dados atualizados
-        if not self.bans:
+        self._purge_expired() # O índice em memória já é a fonte da verdade
+        bans = self.guild_bans(ctx.guild.id)
+        if not bans:
             return await ctx.send("A lista de banidos está vazia.")
             
-        view = ModerationMenu(ctx.author, self.bans, self)
+        view = ModerationMenu(ctx.author, bans, self)
         embed = await view._get_page_embed()
         await ctx.send(embed=embed, view=view)
 
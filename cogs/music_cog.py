@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import hashlib
+import json
 import logging
 import time
 import os
 import re
+import sqlite3
+import difflib
+import random
+import threading
+import multiprocessing
+import subprocess
+from collections import OrderedDict, deque
 from enum import Enum
 from typing import Dict, Optional, List, Union
-from concurrent.futures import ProcessPoolExecutor
-from datetime import datetime
+from urllib.parse import urlparse, parse_qs
 
 import discord
 import yt_dlp
@@ -36,9 +44,112 @@ FFMPEG_OPTIONS = {
 
 logger = logging.getLogger('discord_bot.music_cog')
 SPOTIFY_PLAYLIST_REGEX = re.compile(r"https://open.spotify.com/playlist/([a-zA-Z0-9]+)")
+SPOTIFY_PLAYLIST_FIELDS = "items(track(name,artists(name),external_ids(isrc),duration_ms)),next,total"
+SPOTIFY_PAGE_SIZE = 100
+SPOTIFY_MATCH_CANDIDATES = 3          # Candidatos avaliados por faixa numa única busca (ytsearch3:)
+SPOTIFY_MATCH_MIN_SCORE = 0.35        # Abaixo disso o melhor candidato é considerado um erro de busca
+# Versões que quase nunca são a faixa de estúdio pedida (a não ser que o nome no Spotify também diga).
+SPOTIFY_UNWANTED_TERMS = ('live', 'ao vivo', 'cover', 'remix', 'karaoke', 'mix', 'slowed', 'sped up', '8d', 'reverb', 'instrumental')
 PEER_SIZE = 20
 PEER_THRESHOLD = 5
+PLAYLIST_CONCURRENCY = 4              # Buscas simultâneas por playlist
+SEARCH_RATE_PER_SECOND = 3.0          # Limite global (todos os servidores) de extrações no YouTube
+SEARCH_RATE_BURST = 6
+
+# --- Workers de Extração (yt-dlp) ---
+EXTRACTOR_WORKERS = int(os.getenv("EXTRACTOR_WORKERS", "2"))
+EXTRACTOR_MAX_REQUESTS = 500          # Recicla o processo depois de N extrações
+EXTRACTOR_MAX_RSS_MB = 400            # ...ou se a memória do processo crescer além disso
+EXTRACTOR_TIMEOUT = 60                # Segundos até considerar o worker travado
+EXTRACTOR_HEALTH_INTERVAL = 60        # Intervalo entre os pings dos workers ociosos
+# Busca em duas fases: a busca "flat" só devolve id/título/duração para responder ao /play na hora;
+# a extração completa (formatos/URL de stream) fica para quando a música estiver perto de tocar.
+FLAT_SEARCH = True
 ADMIN_QUEUE_ITEMS_PER_PAGE = 5
+QUEUE_SOFT_LIMIT = 200                # Acima disso o /play recusa novas músicas (a playlist não bloqueia)
+# --- Persistência do Estado de Reprodução ---
+# Em modo cluster (ver bot.py) cada processo só conhece os próprios servidores e guarda o próprio estado.
+STATE_FILE_SUFFIX = f".cluster{os.environ['CLUSTER_ID']}" if os.getenv("CLUSTER_ID") else ""
+STATE_SNAPSHOT_FILE = f"playback_state{STATE_FILE_SUFFIX}.json"
+STATE_JOURNAL_FILE = f"playback_state{STATE_FILE_SUFFIX}.journal"
+STATE_FLUSH_INTERVAL = 5              # Segundos entre gravações do journal
+STATE_COMPACT_BYTES = 1024 * 1024     # Tamanho do journal que dispara a compactação
+STATE_RESTORE_STAGGER = 1.0           # Intervalo entre servidores restaurados no startup
+MENU_RENDER_DELAY = 1.0               # Janela (s) em que atualizações do menu são agrupadas numa só edição
+MENU_RENDER_MAX_DELAY = 15.0          # Teto do backoff quando o Discord limita as edições
+MENU_SLOW_EDIT = 2.0                  # Uma edição mais lenta que isso indica fila no rate limiter
+
+# --- Cache de Buscas ---
+SEARCH_CACHE_FILE = "search_cache.db"
+SEARCH_CACHE_MEMORY_SIZE = 512        # Entradas mantidas no LRU em memória
+QUERY_CACHE_TTL = 7 * 24 * 3600       # Uma busca pode passar a apontar para outro vídeo com o tempo
+STREAM_URL_SAFETY_MARGIN = 10 * 60    # Considera a URL expirada 10 min antes do 'expire' real
+STREAM_URL_DEFAULT_TTL = 5 * 3600     # Usado quando a URL não traz o parâmetro 'expire'
+STREAM_REFRESH_LEAD = 30              # Segundos antes do fim da música atual para renovar a URL da próxima
+SEARCH_CACHE_FLUSH_INTERVAL = 2       # Segundos entre gravações em lote (fora do event loop)
+SEARCH_CACHE_PRUNE_INTERVAL = 3600    # Segundos entre limpezas das buscas e URLs vencidas
+
+# --- Pré-carregamento (Prefetch) ---
+PREFETCH_DEPTH_DEFAULT = 2            # Quantas músicas da fila são resolvidas enquanto a atual toca
+PREFETCH_DEPTH_MAX = 3
+PREFETCH_WARM_FFMPEG = True           # Abre o FFmpeg da próxima música antes da troca de faixa
+
+# --- Saída em Opus ---
+OPUS_PASSTHROUGH = True               # Entrega Opus direto ao Discord (sem PCM/volume em Python)
+OPUS_BITRATE = 128                    # kbps usados quando o FFmpeg precisa re-encodar (volume != 100%)
+YOUTUBE_OPUS_ITAGS = {'249', '250', '251'}
+FRAME_DURATION = 0.02                 # Cada read() de uma AudioSource entrega 20 ms de áudio
+RESUME_TOLERANCE = 5                  # Fim antes de (duração - isso) é tratado como queda do stream
+RESUME_MAX_ATTEMPTS = 3               # Tentativas de retomar a mesma música após quedas
+
+# --- Streams Compartilhados (opt-in) ---
+# Um único FFmpeg por vídeo alimenta todos os servidores que tocam a mesma música ao mesmo tempo.
+SHARED_STREAMS = os.getenv("SHARED_STREAMS", "0") == "1"
+SHARED_BUFFER_FRAMES = 30000          # Frames Opus (20 ms) mantidos por stream: ~10 min de áudio
+SHARED_MAX_LAG_FRAMES = 1500          # Com o buffer cheio, quem estiver 30 s atrás do mais rápido segue num FFmpeg próprio
+
+# --- Cache de Áudio em Disco (opcional) ---
+# Um diretório por cluster: o índice de cada processo só vale para os próprios arquivos (downloads .part e remoções
+# de um cluster não podem pegar o outro de surpresa). O orçamento total é dividido entre eles.
+AUDIO_CACHE_DIR = f"audio_cache{STATE_FILE_SUFFIX}"
+AUDIO_CACHE_MB = int(os.getenv("AUDIO_CACHE_MB", "0")) // (max(1, int(os.getenv("CLUSTER_COUNT", "1"))) if os.getenv("CLUSTER_ID") else 1)  # 0 desativa o cache
+AUDIO_CACHE_MIN_PLAYS = 3             # Reproduções estimadas antes de uma música ser gravada em disco
+AUDIO_CACHE_MAX_DURATION = 15 * 60    # Mixes e lives longas não são cacheadas
+LOCAL_FFMPEG_OPTIONS = {'before_options': '', 'options': '-vn -nostdin'}
+
+# --- Normalização de Loudness (EBU R128) ---
+LOUDNESS_NORMALIZATION = True
+LOUDNESS_TARGET_LUFS = -14.0          # Mesmo alvo das plataformas de streaming
+LOUDNESS_MAX_BOOST = 6.0              # dB; limita o ganho em faixas muito baixas para não estourar
+LOUDNESS_MAX_CUT = -12.0
+LOUDNESS_TOLERANCE_DB = 1.0           # Abaixo disso o ganho é ignorado e o Opus segue sendo copiado sem re-encode
+LOUDNESS_ANALYZE_SECONDS = 300        # Trecho analisado; suficiente para a loudness integrada de quase toda música
+LOUDNESS_TIMEOUT = 150                # Tempo máximo de uma análise no worker
+LOUDNESS_CONCURRENCY = 1              # Workers próprios da análise: as buscas nunca esperam atrás dela
+
+# --- Controle de Admissão de Sessões de Voz ---
+MAX_VOICE_SESSIONS = int(os.getenv("MAX_VOICE_SESSIONS", "40"))  # Sessões simultâneas por processo
+CPU_BUDGET_PERCENT = 85               # Acima disso novas sessões esperam e buscas são adiadas
+RSS_BUDGET_MB = int(os.getenv("RSS_BUDGET_MB", "1800"))          # Memória total (bot + FFmpegs); a Discloud dá 2048 MB
+ADMISSION_SAMPLE_INTERVAL = 5         # Segundos entre amostras de CPU/memória
+ADMISSION_WAIT = 20                   # Quanto um pedido de sessão nova espera na fila antes de ser recusado
+SEARCH_BACKOFF_MAX = 10               # Atraso máximo de uma busca enquanto a CPU estiver acima do orçamento
+WORKER_NICE = 10                      # Workers de busca rodam com prioridade menor que o encode das sessões
+
+# --- Efeitos de Áudio ---
+# nome: (rótulo, filtro FFmpeg, fator de velocidade, grupo). Efeitos do mesmo grupo se excluem.
+# A ordem aqui é a ordem em que os filtros entram no filtergraph.
+AUDIO_EFFECTS = {
+    'nightcore': ("Nightcore", "aresample=48000,asetrate=60000,aresample=48000", 1.25, 'tempo'),
+    'vaporwave': ("Vaporwave", "aresample=48000,asetrate=38400,aresample=48000", 0.8, 'tempo'),
+    'speed': ("Acelerado", "atempo=1.25", 1.25, 'tempo'),
+    'slow': ("Lento", "atempo=0.8", 0.8, 'tempo'),
+    'bassboost': ("Bass Boost", "bass=g=8:f=110:w=0.6", 1.0, 'bass'),
+    'pop': ("EQ Pop", "equalizer=f=100:t=q:w=1:g=2,equalizer=f=3000:t=q:w=1:g=3,equalizer=f=10000:t=q:w=1:g=2", 1.0, 'eq'),
+    'vocal': ("EQ Vocal", "highpass=f=80,equalizer=f=1500:t=q:w=1.5:g=4", 1.0, 'eq'),
+    'treble': ("EQ Agudos", "treble=g=5", 1.0, 'eq'),
+    '8d': ("8D", "apulsator=hz=0.08", 1.0, 'pan'),
+}
 
 # --- Decorator de Verificação de Ban ---
 def is_not_banned():
@@ -52,17 +163,8 @@ def is_not_banned():
         if not mod_cog:
             logging.warning("Cog de Moderação não encontrado."); return True
 
-        member_id_str = str(author.id)
-        bans = mod_cog._load_bans()
-        
-        if member_id_str in bans:
-            ban_info = bans[member_id_str]
-            until = ban_info.get("until")
-            if until:
-                if datetime.utcnow() > datetime.fromisoformat(until):
-                    del bans[member_id_str]; mod_cog.bans = bans; mod_cog._save_bans()
-                    return True
-            
+        guild = ctx_or_interaction.guild
+        if mod_cog.is_banned(guild.id if guild else None, author.id):
             if isinstance(ctx_or_interaction, discord.Interaction):
                 await ctx_or_interaction.response.send_message("🚫 Você está proibido de usar os comandos de música.", ephemeral=True)
             else:
@@ -72,63 +174,1110 @@ def is_not_banned():
     return commands.check(predicate)
 
 # --- Componentes de Classes ---
-def search_sync(query: str) -> Optional[dict]:
-    with yt_dlp.YoutubeDL(YDL_OPTIONS) as ydl:
+def slim_info(data: Optional[dict]) -> Optional[dict]:
+    # Devolve ao processo principal só o que o bot usa (a lista de formatos é grande para serializar).
+    if not data: return None
+    return {key: data.get(key) for key in ('id', 'title', 'duration', 'thumbnail', 'webpage_url', 'url')}
+
+def search_sync(ydl: yt_dlp.YoutubeDL, query: str) -> Optional[dict]:
+    try:
+        data = ydl.extract_info(f"ytsearch:{query}", download=False)
+        if 'entries' in data and data['entries']: return slim_info(data['entries'][0])
+        return None
+    except Exception as e:
+        logging.error(f"Erro no processo de busca do YTDL para '{query}': {e}"); return None
+
+def extract_sync(ydl: yt_dlp.YoutubeDL, url: str) -> Optional[dict]:
+    # Usado quando já conhecemos o vídeo (cache): evita o 'ytsearch:' e resolve só o stream.
+    try: return slim_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        logging.error(f"Erro no processo de extração do YTDL para '{url}': {e}"); return None
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+def stream_url_expiry(url: str) -> float:
+    # As URLs do googlevideo trazem o timestamp de expiração no parâmetro 'expire'.
+    try: expire = float(parse_qs(urlparse(url).query)['expire'][0])
+    except (KeyError, IndexError, ValueError): expire = time.time() + STREAM_URL_DEFAULT_TTL
+    return expire - STREAM_URL_SAFETY_MARGIN
+
+def measure_loudness_sync(ydl: Optional[yt_dlp.YoutubeDL], url: str) -> Optional[float]:
+    # Executado no worker: o filtro ebur128 do FFmpeg mede a loudness integrada (LUFS) do áudio.
+    # 'ydl' é sempre None (a tarefa não usa o yt-dlp); o parâmetro só mantém a assinatura comum das tarefas.
+    input_options = [] if is_local_file(url) else FFMPEG_OPTIONS['before_options'].split()
+    result = subprocess.run(
+        ['ffmpeg', '-nostdin', '-hide_banner', *input_options, '-t', str(LOUDNESS_ANALYZE_SECONDS), '-i', url,
+         '-vn', '-af', 'ebur128=framelog=quiet', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=LOUDNESS_TIMEOUT - 10)
+    # O resumo final vem por último no stderr; a linha "I:" dele é a loudness integrada.
+    matches = re.findall(r"I:\s+(-?[\d.]+) LUFS", result.stderr.decode(errors='ignore'))
+    if result.returncode != 0 or not matches: return None
+    lufs = float(matches[-1])
+    return lufs if lufs > -70 else None # -70 LUFS é o gate absoluto: silêncio, nada a normalizar
+
+def loudness_gain(lufs: Optional[float]) -> float:
+    if not LOUDNESS_NORMALIZATION or lufs is None: return 0.0
+    gain = max(LOUDNESS_MAX_CUT, min(LOUDNESS_MAX_BOOST, LOUDNESS_TARGET_LUFS - lufs))
+    return gain if abs(gain) >= LOUDNESS_TOLERANCE_DB else 0.0
+
+def gain_factor(gain_db: float) -> float: return 10 ** (gain_db / 20)
+
+def compile_effects(effects: List[str]) -> tuple:
+    """Monta o filtergraph '-af' de uma lista de efeitos e o fator de velocidade resultante."""
+    filters = [AUDIO_EFFECTS[name][1] for name in AUDIO_EFFECTS if name in effects]
+    speed = 1.0
+    for name in effects:
+        if name in AUDIO_EFFECTS: speed *= AUDIO_EFFECTS[name][2]
+    return ','.join(filters), speed
+
+def is_local_file(url: str) -> bool:
+    return not url.startswith(('http://', 'https://'))
+
+def stream_is_opus(url: str) -> bool:
+    # O cache local guarda sempre Opus/WebM.
+    if is_local_file(url): return url.endswith('.webm')
+    # Os formatos de áudio WebM do YouTube (itags 249/250/251) já vêm em Opus.
+    params = parse_qs(urlparse(url).query)
+    return params.get('mime', [''])[0] == 'audio/webm' or params.get('itag', [''])[0] in YOUTUBE_OPUS_ITAGS
+
+class TrackedAudio(discord.AudioSource):
+    """Repassa os frames da fonte real contando quantos já foram consumidos pelo player.
+
+    A posição sai dos frames realmente enviados, então pausas e travamentos não a distorcem.
+    Com efeitos de tempo, cada frame enviado equivale a `speed` frames da música original.
+    """
+    def __init__(self, original: discord.AudioSource, start_at: float = 0.0, speed: float = 1.0):
+        self.original = original; self.start_at = start_at; self.speed = speed; self.frames = 0
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if data: self.frames += 1
+        return data
+
+    def is_opus(self) -> bool: return self.original.is_opus()
+    def cleanup(self): self.original.cleanup()
+
+    @property
+    def position(self) -> float: return self.start_at + self.frames * FRAME_DURATION * self.speed
+
+def open_opus_source(url: str, gain_db: float = 0.0, start_at: float = 0.0) -> discord.FFmpegOpusAudio:
+    # Opus sem volume nem efeitos por servidor: o que o stream compartilhado toca (e quem se desprende dele).
+    before_options = f"-ss {start_at:.2f} {FFMPEG_OPTIONS['before_options']}" if start_at > 0 else FFMPEG_OPTIONS['before_options']
+    if not gain_db and stream_is_opus(url): return discord.FFmpegOpusAudio(url, codec='opus', before_options=before_options, options=FFMPEG_OPTIONS['options'])
+    # O ganho de loudness é da música, não do servidor: pode ser aplicado uma vez para todos.
+    options = f"{FFMPEG_OPTIONS['options']} -af volume={gain_db:.2f}dB" if gain_db else FFMPEG_OPTIONS['options']
+    return discord.FFmpegOpusAudio(url, bitrate=OPUS_BITRATE, before_options=before_options, options=options)
+
+class SharedOpusStream:
+    """Um FFmpeg por vídeo gravando pacotes Opus num buffer circular lido por vários servidores."""
+    def __init__(self, key: str, url: str, hub: 'SharedStreamHub', gain_db: float = 0.0):
+        self.key = key; self.hub = hub; self.url = url; self.gain_db = gain_db
+        self.frames: List[bytes] = []; self.base = 0 # Índice absoluto de frames[0]
+        self.readers: set = set(); self.done = False; self.closed = False
+        self.cond = threading.Condition()
+        self.source = open_opus_source(url, gain_db)
+        self.thread = threading.Thread(target=self._pump, name=f"shared-stream-{key}", daemon=True)
+
+    def _pump(self):
+        while not self.closed:
+            packet = self.source.read()
+            with self.cond:
+                if not packet: break
+                while len(self.frames) >= SHARED_BUFFER_FRAMES and not self.closed:
+                    # Um servidor muito atrás (pausado, travado) não segura os outros: é desprendido do buffer.
+                    fastest = max((reader.offset for reader in self.readers), default=self.base)
+                    for reader in [r for r in self.readers if r.offset <= self.base and fastest - r.offset >= SHARED_MAX_LAG_FRAMES]:
+                        reader.detached = True; self.readers.discard(reader)
+                    # Descarta o que todos já leram; se o leitor mais lento ainda precisa, espera por ele.
+                    slowest = min((reader.offset for reader in self.readers), default=self.base + len(self.frames))
+                    if slowest > self.base:
+                        del self.frames[:slowest - self.base]; self.base = slowest
+                    else: self.cond.wait(0.5)
+                self.frames.append(packet); self.cond.notify_all()
+        with self.cond:
+            self.done = True; self.cond.notify_all()
+        self.source.cleanup()
+
+    def read_at(self, offset: int) -> bytes:
+        # Chamado pela thread de áudio de cada servidor; bloqueia como um read() no pipe do FFmpeg.
+        with self.cond:
+            while offset >= self.base + len(self.frames) and not self.done and not self.closed:
+                self.cond.wait(1.0)
+            if offset < self.base or offset >= self.base + len(self.frames): return b''
+            return self.frames[offset - self.base]
+
+    def close(self):
+        with self.cond:
+            self.closed = True; self.cond.notify_all()
+        self.source.cleanup()
+
+class SharedAudioReader(discord.AudioSource):
+    def __init__(self, stream: SharedOpusStream):
+        self.stream = stream; self.offset = 0; self.released = False
+        self.detached = False; self.private: Optional[discord.FFmpegOpusAudio] = None
+
+    def read(self) -> bytes:
+        if not self.detached:
+            data = self.stream.read_at(self.offset)
+            # O pump marca 'detached' antes de descartar os frames, então um b'' aqui sem a marca é o fim da música.
+            if data or not self.detached:
+                if data: self.offset += 1
+                return data
+        if self.private is None:
+            # O buffer seguiu sem este servidor: continua num FFmpeg próprio a partir do frame onde parou.
+            self._release_shared()
+            self.private = open_opus_source(self.stream.url, self.stream.gain_db, self.offset * FRAME_DURATION)
+            logger.info(f"Servidor desprendido do stream compartilhado '{self.stream.key}' em {self.offset * FRAME_DURATION:.0f}s.")
+        data = self.private.read()
+        if data: self.offset += 1
+        return data
+
+    def is_opus(self) -> bool: return True
+
+    def _release_shared(self):
+        if not self.released:
+            self.released = True; self.stream.hub.release(self)
+
+    def cleanup(self):
+        self._release_shared()
+        if self.private: self.private.cleanup()
+
+class SharedStreamHub:
+    """Registro dos streams compartilhados, com contagem de referências e remoção do último leitor."""
+    def __init__(self):
+        self.streams: Dict[str, SharedOpusStream] = {}; self.lock = threading.Lock()
+
+    def open(self, key: str, url: str, gain_db: float = 0.0) -> SharedAudioReader:
+        key = f"{key}@{gain_db:.1f}" if gain_db else key
+        with self.lock:
+            stream = self.streams.get(key)
+            # Só dá para entrar num stream que ainda guarda o começo da música.
+            if not stream or stream.closed or stream.base > 0:
+                stream = SharedOpusStream(key, url, self, gain_db); self.streams[key] = stream
+            reader = SharedAudioReader(stream)
+            with stream.cond: stream.readers.add(reader)
+            # O primeiro leitor entra antes do FFmpeg começar, para nenhum frame ser descartado antes da hora.
+            if not stream.thread.is_alive() and not stream.done: stream.thread.start()
+            return reader
+
+    def release(self, reader: SharedAudioReader):
+        stream = reader.stream
+        with self.lock:
+            with stream.cond:
+                stream.readers.discard(reader); stream.cond.notify_all()
+                if stream.readers: return
+            if self.streams.get(stream.key) is stream: del self.streams[stream.key]
+        stream.close()
+
+    def stats(self) -> List[tuple]:
+        with self.lock: return [(key, len(s.readers), len(s.frames)) for key, s in self.streams.items()]
+
+shared_streams = SharedStreamHub()
+
+class FrequencySketch:
+    """Count-min sketch com envelhecimento: estima quantas vezes cada vídeo tocou, em memória constante."""
+    def __init__(self, width: int = 4096, depth: int = 4, sample_size: int = 20000):
+        self.width = width; self.depth = depth; self.sample_size = sample_size
+        self.table = [[0] * width for _ in range(depth)]; self.additions = 0
+
+    def _indexes(self, key: str) -> List[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[i * 4:(i + 1) * 4], 'little') % self.width for i in range(self.depth)]
+
+    def add(self, key: str):
+        for row, index in zip(self.table, self._indexes(key)): row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            # Divide tudo por 2 de tempos em tempos para que músicas que saíram de moda percam o lugar.
+            self.table = [[count // 2 for count in row] for row in self.table]; self.additions //= 2
+
+    def estimate(self, key: str) -> int:
+        return min(row[index] for row, index in zip(self.table, self._indexes(key)))
+
+class AudioCache:
+    """Cópias locais (Opus/WebM) das músicas mais tocadas, com orçamento de espaço e remoção LFU/LRU."""
+    def __init__(self, directory: str = AUDIO_CACHE_DIR, budget_mb: int = AUDIO_CACHE_MB):
+        self.directory = directory; self.budget = budget_mb * 1024 * 1024; self.enabled = budget_mb > 0
+        self.sketch = FrequencySketch()
+        self.files: Dict[str, list] = {} # video_id -> [tamanho, último acesso]
+        self.downloading: set = set(); self.download_lock = asyncio.Semaphore(1)
+        if self.enabled: self._scan()
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'): os.remove(path); continue # Download interrompido
+            if name.endswith('.webm'):
+                stat = os.stat(path); self.files[name[:-5]] = [stat.st_size, stat.st_mtime]
+        logger.info(f"Cache de áudio: {len(self.files)} arquivos, {self.total_size() // (1024 * 1024)} MB.")
+
+    def total_size(self) -> int: return sum(size for size, _ in self.files.values())
+    def _path(self, video_id: str) -> str: return os.path.join(self.directory, f"{video_id}.webm")
+
+    def lookup(self, video_id: Optional[str]) -> Optional[str]:
+        if not self.enabled or not video_id or video_id not in self.files: return None
+        self.files[video_id][1] = time.time()
+        return self._path(video_id)
+
+    def record_play(self, song: 'Song', url: str, loop: asyncio.AbstractEventLoop):
+        if not self.enabled or not song.video_id: return
+        self.sketch.add(song.video_id)
+        if song.video_id in self.files or song.video_id in self.downloading or is_local_file(url): return
+        if not 0 < song.duration <= AUDIO_CACHE_MAX_DURATION or self.sketch.estimate(song.video_id) < AUDIO_CACHE_MIN_PLAYS: return
+        self.downloading.add(song.video_id)
+        loop.create_task(self._download(song.video_id, url))
+
+    async def _download(self, video_id: str, url: str):
+        path = self._path(video_id); tmp_path = path + ".part"
+        codec = ['-c:a', 'copy'] if stream_is_opus(url) else ['-c:a', 'libopus', '-b:a', f'{OPUS_BITRATE}k']
         try:
-            data = ydl.extract_info(f"ytsearch:{query}", download=False)
-            if 'entries' in data and data['entries']: return data['entries'][0]
-            return None
-        except Exception as e:
-            logging.error(f"Erro no processo de busca do YTDL para '{query}': {e}"); return None
+            async with self.download_lock: # Um download por vez para não disputar banda com o áudio ao vivo
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', *FFMPEG_OPTIONS['before_options'].split(),
+                    '-i', url, '-vn', *codec, '-f', 'webm', '-y', tmp_path,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                logger.warning(f"Falha ao gravar '{video_id}' no cache de áudio: {stderr.decode(errors='ignore')[:200]}")
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            self.files[video_id] = [os.path.getsize(path), time.time()]
+            logger.info(f"'{video_id}' gravado no cache de áudio.", extra={'sampled': True})
+            self._evict()
+        except Exception as e: logger.error(f"Erro no download para o cache de áudio de '{video_id}': {e}")
+        finally: self.downloading.discard(video_id)
+
+    def _evict(self):
+        total = self.total_size()
+        while total > self.budget and self.files:
+            # Sai a menos tocada; no empate, a acessada há mais tempo.
+            victim = min(self.files, key=lambda vid: (self.sketch.estimate(vid), self.files[vid][1]))
+            size, _ = self.files.pop(victim); total -= size
+            try: os.remove(self._path(victim))
+            except OSError as e: logger.warning(f"Não foi possível remover '{victim}' do cache de áudio: {e}")
+
+def create_audio_source(url: str, volume: float, start_at: float = 0.0, shared_key: Optional[str] = None, gain_db: float = 0.0,
+                        effects: Optional[List[str]] = None) -> TrackedAudio:
+    """Cria a fonte de áudio mais barata possível para a URL.
+
+    Com volume em 100%, sem ganho de loudness, sem efeitos e stream Opus, os pacotes são copiados sem decodificar.
+    Volume, ganho e efeitos são aplicados pelo próprio FFmpeg. O caminho PCM + PCMVolumeTransformer fica só como fallback.
+    """
+    filters, speed = compile_effects(effects or [])
+    ffmpeg_options = LOCAL_FFMPEG_OPTIONS if is_local_file(url) else FFMPEG_OPTIONS
+    before_options = ffmpeg_options['before_options']
+    # '-ss' antes do '-i' faz um seek rápido na entrada, sem decodificar o trecho pulado.
+    if start_at > 0: before_options = f"-ss {start_at:.2f} {before_options}".strip()
+    options = ffmpeg_options['options']
+    # O áudio compartilhado é idêntico para todos: só serve sem volume próprio e do começo da música.
+    if SHARED_STREAMS and shared_key and volume == 1.0 and start_at <= 0 and not filters and not is_local_file(url):
+        try: return TrackedAudio(shared_streams.open(shared_key, url, gain_db))
+        except Exception as e: logger.warning(f"Falha ao abrir stream compartilhado, usando um FFmpeg próprio: {e}")
+    factor = volume * gain_factor(gain_db)
+    if OPUS_PASSTHROUGH:
+        try:
+            if factor == 1.0 and not filters and stream_is_opus(url):
+                return TrackedAudio(discord.FFmpegOpusAudio(url, codec='opus', before_options=before_options, options=options), start_at)
+            graph = f"{filters},volume={factor:.3f}" if filters else f"volume={factor:.3f}"
+            return TrackedAudio(discord.FFmpegOpusAudio(url, bitrate=OPUS_BITRATE, before_options=before_options, options=f"{options} -af {graph}"), start_at, speed)
+        except Exception as e: logger.warning(f"Falha ao criar fonte Opus, usando PCM: {e}")
+    if filters: options = f"{options} -af {filters}"
+    return TrackedAudio(discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(url, before_options=before_options, options=options), volume=factor), start_at, speed)
+
+def parse_timestamp(value: str) -> Optional[float]:
+    # Aceita "90", "1:30" ou "1:02:30".
+    try:
+        seconds = 0.0
+        for part in value.strip().split(':'): seconds = seconds * 60 + float(part)
+        return seconds if seconds >= 0 else None
+    except ValueError: return None
+
+def flat_entry_metadata(entry: dict) -> dict:
+    # Entradas de busca "flat" não têm formatos: o 'url' delas é a página do vídeo, não um stream.
+    thumbnails = entry.get('thumbnails') or []
+    return {
+        'id': entry['id'], 'title': entry.get('title'), 'duration': int(entry.get('duration') or 0),
+        'thumbnail': entry.get('thumbnail') or (thumbnails[-1].get('url') if thumbnails else None),
+        'webpage_url': f"https://www.youtube.com/watch?v={entry['id']}",
+    }
+
+def search_candidates_sync(ydl: yt_dlp.YoutubeDL, query: str, count: int) -> List[dict]:
+    # Busca "flat": lista os N primeiros resultados sem extrair os formatos de cada um.
+    try:
+        data = ydl.extract_info(f"ytsearch{count}:{query}", download=False)
+        return [flat_entry_metadata(e) for e in data.get('entries') or [] if e and e.get('id')]
+    except Exception as e:
+        logging.error(f"Erro no processo de busca do YTDL para '{query}': {e}"); return []
+
+class PlaylistTrack:
+    # Faixa vinda do Spotify, ainda não resolvida no YouTube.
+    def __init__(self, name: str, artist: str, isrc: Optional[str] = None, duration: int = 0):
+        self.name = name; self.artist = artist; self.isrc = isrc; self.duration = duration
+        self.query = f"{name} {artist}"
+
+    def to_list(self) -> list:
+        return [self.name, self.artist, self.isrc, self.duration]
+
+def score_candidate(track: PlaylistTrack, candidate: dict) -> float:
+    title = normalize_query(candidate.get('title') or '')
+    wanted = normalize_query(track.query)
+    score = difflib.SequenceMatcher(None, wanted, title).ratio()
+    if normalize_query(track.name) in title: score += 0.3
+    score -= 0.25 * sum(1 for term in SPOTIFY_UNWANTED_TERMS if term in title and term not in wanted)
+    if track.duration and candidate.get('duration'):
+        # Cada 10s de diferença custa 0.1; mixes longos e versões ao vivo caem rápido.
+        score -= min(abs(candidate['duration'] - track.duration) / 100, 1.0)
+    return score
+
+def pick_best_candidate(track: PlaylistTrack, candidates: List[dict]) -> Optional[dict]:
+    if not candidates: return None
+    best = max(candidates, key=lambda c: score_candidate(track, c))
+    return best if score_candidate(track, best) >= SPOTIFY_MATCH_MIN_SCORE else None
+
+# --- Workers de Extração ---
+# tipo de requisição -> (função, usa a instância "flat" do YoutubeDL)
+EXTRACTOR_TASKS = {
+    'search': (search_sync, False),
+    'extract': (extract_sync, False),
+    'candidates': (search_candidates_sync, True),
+    'loudness': (measure_loudness_sync, None), # Não usa o yt-dlp, só o FFmpeg
+}
+
+def worker_rss_kb() -> int:
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError: return 0
+
+def worker_context():
+    # O worker nasce de um processo limpo (forkserver), não de um fork do bot: as threads de voz, log e SQLite
+    # podem estar segurando um lock no instante do fork, e o filho herdaria esse lock travado para sempre.
+    try: ctx = multiprocessing.get_context('forkserver')
+    except ValueError: return multiprocessing.get_context('spawn') # Windows não tem forkserver
+    ctx.set_forkserver_preload([__name__]) # O forkserver importa o yt-dlp uma vez; cada worker já nasce com ele
+    return ctx
+
+def extractor_worker_main(conn):
+    # Processo de longa duração: opções, cookies, sessão HTTP e extratores são inicializados uma única vez.
+    # Prioridade menor: sob carga, o encode das sessões de voz ganha a CPU antes das buscas.
+    if hasattr(os, 'nice'):
+        try: os.nice(WORKER_NICE)
+        except OSError: pass
+    ydls: Dict[bool, yt_dlp.YoutubeDL] = {}
+    while True:
+        try: request = conn.recv()
+        except (EOFError, KeyboardInterrupt): break
+        if request is None: break
+        kind, args = request
+        if kind == 'ping':
+            conn.send((True, None, worker_rss_kb())); continue
+        func, flat = EXTRACTOR_TASKS[kind]
+        try:
+            if flat is not None and flat not in ydls: ydls[flat] = yt_dlp.YoutubeDL(dict(YDL_OPTIONS, extract_flat='in_playlist') if flat else YDL_OPTIONS)
+            conn.send((True, func(ydls.get(flat), *args), worker_rss_kb()))
+        except Exception as e: conn.send((False, repr(e), worker_rss_kb()))
+    for ydl in ydls.values(): ydl.close()
+
+class ExtractorWorker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=extractor_worker_main, args=(child_conn,), daemon=True)
+        self.process.start(); child_conn.close()
+        self.requests = 0; self.rss_kb = 0
+
+    def roundtrip(self, request: tuple, timeout: float) -> tuple:
+        # Bloqueante: sempre executado numa thread, nunca no event loop.
+        self.conn.send(request)
+        if not self.conn.poll(timeout): raise TimeoutError(f"worker {self.process.pid} não respondeu em {timeout}s")
+        return self.conn.recv()
+
+    def stop(self):
+        try: self.conn.send(None)
+        except OSError: pass
+        self.process.join(timeout=2)
+        if self.process.is_alive(): self.process.kill()
+        self.conn.close()
+
+class ExtractorPool:
+    """Pool de processos yt-dlp persistentes, com health check e reciclagem automática."""
+    def __init__(self, loop: asyncio.AbstractEventLoop, size: int = EXTRACTOR_WORKERS):
+        self.loop = loop; self.size = max(1, size); self._ctx = worker_context()
+        self.workers: List[ExtractorWorker] = []; self._idle: asyncio.Queue = asyncio.Queue()
+        for _ in range(self.size): self._spawn()
+        self.health_task = loop.create_task(self._health_loop())
+
+    def _spawn(self):
+        worker = ExtractorWorker(self._ctx)
+        self.workers.append(worker); self._idle.put_nowait(worker)
+
+    def _recycle(self, worker: ExtractorWorker, reason: str):
+        logger.info(f"Reciclando worker de extração {worker.process.pid} ({reason}, {worker.requests} requisições, {worker.rss_kb // 1024} MB).")
+        self.workers.remove(worker)
+        self.loop.run_in_executor(None, worker.stop)
+        self._spawn()
+
+    async def run(self, kind: str, *args, timeout: float = EXTRACTOR_TIMEOUT):
+        worker = await self._idle.get()
+        # O shield garante que o worker volte ao pool mesmo se quem pediu for cancelado.
+        return await asyncio.shield(self.loop.create_task(self._serve(worker, (kind, args), timeout)))
+
+    async def _serve(self, worker: ExtractorWorker, request: tuple, timeout: float = EXTRACTOR_TIMEOUT):
+        recycle_reason = None
+        try:
+            ok, result, worker.rss_kb = await self.loop.run_in_executor(None, worker.roundtrip, request, timeout)
+            worker.requests += 1
+            if worker.requests >= EXTRACTOR_MAX_REQUESTS: recycle_reason = "limite de requisições"
+            elif worker.rss_kb > EXTRACTOR_MAX_RSS_MB * 1024: recycle_reason = "uso de memória"
+            if not ok: raise RuntimeError(result)
+            return result
+        except (TimeoutError, EOFError, OSError) as e:
+            recycle_reason = f"falha: {e}"; raise
+        finally:
+            if recycle_reason: self._recycle(worker, recycle_reason)
+            else: self._idle.put_nowait(worker)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(EXTRACTOR_HEALTH_INTERVAL)
+            for _ in range(self._idle.qsize()):
+                worker = self._idle.get_nowait()
+                try: _, _, worker.rss_kb = await self.loop.run_in_executor(None, worker.roundtrip, ('ping', ()), 5)
+                except Exception as e:
+                    self._recycle(worker, f"health check falhou: {e}"); continue
+                self._idle.put_nowait(worker)
+
+    def stats(self) -> List[tuple]:
+        return [(w.process.pid, w.requests, w.rss_kb // 1024) for w in self.workers]
+
+    def shutdown(self):
+        self.health_task.cancel()
+        for worker in self.workers: worker.stop()
+        self.workers.clear()
+
+class SearchCache:
+    """Cache em duas camadas (LRU em memória + SQLite) de busca -> metadados do vídeo.
+
+    A URL de stream fica numa tabela separada, com validade própria tirada do parâmetro 'expire'.
+    A loudness medida de cada vídeo também fica aqui, já que não muda com o tempo.
+    As leituras são pontuais e ficam no event loop; as escritas vão para uma fila gravada em lote numa thread
+    (write), com uma conexão própria. Até lá, as camadas em memória respondem pelo que ainda não foi gravado.
+    """
+    METADATA_FIELDS = ('id', 'title', 'duration', 'thumbnail', 'webpage_url')
+
+    def __init__(self, path: str = SEARCH_CACHE_FILE, memory_size: int = SEARCH_CACHE_MEMORY_SIZE):
+        self.memory_size = memory_size
+        self._queries: 'OrderedDict[str, dict]' = OrderedDict()
+        self._streams: Dict[str, tuple] = {}; self._loudness: Dict[str, float] = {}; self._isrc: Dict[str, dict] = {}
+        self._pending: List[tuple] = []; self.write_lock = threading.Lock()
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL"); self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, video_id TEXT NOT NULL, cached_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, title TEXT, duration INTEGER, thumbnail TEXT, webpage_url TEXT);
+            CREATE TABLE IF NOT EXISTS streams (video_id TEXT PRIMARY KEY, url TEXT NOT NULL, expires_at REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS isrc (isrc TEXT PRIMARY KEY, video_id TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS loudness (video_id TEXT PRIMARY KEY, lufs REAL NOT NULL);
+        """)
+        self.db.commit()
+        self.writer = sqlite3.connect(path, check_same_thread=False)
+
+    def take_pending(self) -> List[tuple]:
+        batch, self._pending = self._pending, []
+        return batch
+
+    def write(self, batch: List[tuple], prune: bool = False):
+        """Grava um lote de (sql, parâmetros) numa transação; roda numa thread, nunca no event loop."""
+        now = time.time()
+        try:
+            with self.write_lock, self.writer:
+                for sql, params in batch: self.writer.execute(sql, params)
+                if prune:
+                    # Buscas e URLs vencidas nunca mais são lidas; vídeos sem busca nem ISRC apontando para eles também não.
+                    self.writer.execute("DELETE FROM queries WHERE cached_at <= ?", (now - QUERY_CACHE_TTL,))
+                    self.writer.execute("DELETE FROM streams WHERE expires_at <= ?", (now,))
+                    self.writer.execute("DELETE FROM videos WHERE video_id NOT IN (SELECT video_id FROM queries) AND video_id NOT IN (SELECT video_id FROM isrc)")
+        except sqlite3.Error as e: logger.warning(f"Falha ao gravar o cache de buscas: {e}")
+
+    def prune_memory(self):
+        now = time.time()
+        for video_id in [vid for vid, (_, expires_at) in self._streams.items() if expires_at <= now]: del self._streams[video_id]
+
+    def close(self):
+        self.write(self.take_pending()); self.writer.close(); self.db.close()
+
+    def _remember(self, key: str, metadata: dict):
+        self._queries[key] = metadata; self._queries.move_to_end(key)
+        while len(self._queries) > self.memory_size: self._queries.popitem(last=False)
+
+    def get(self, query: str) -> Optional[dict]:
+        """Retorna os metadados em cache (com 'url' apenas se o stream ainda for válido)."""
+        key = normalize_query(query)
+        metadata = self._queries.get(key)
+        if metadata and time.time() - metadata['cached_at'] > QUERY_CACHE_TTL:
+            del self._queries[key]; metadata = None
+        if metadata: self._queries.move_to_end(key)
+        else:
+            row = self.db.execute(
+                "SELECT v.video_id, v.title, v.duration, v.thumbnail, v.webpage_url, q.cached_at FROM queries q "
+                "JOIN videos v ON v.video_id = q.video_id WHERE q.query = ? AND q.cached_at > ?",
+                (key, time.time() - QUERY_CACHE_TTL)).fetchone()
+            if not row: return None
+            metadata = dict(zip(self.METADATA_FIELDS + ('cached_at',), row))
+            self._remember(key, metadata)
+        data = dict(metadata)
+        url = self.get_stream(data['id'])
+        if url: data['url'] = url
+        return data
+
+    def put(self, query: str, data: dict):
+        if not data.get('id'): return
+        key = normalize_query(query)
+        metadata = {field: data.get(field) for field in self.METADATA_FIELDS}
+        metadata['cached_at'] = time.time()
+        self._remember(key, metadata)
+        self._pending.append(("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)", tuple(metadata[f] for f in self.METADATA_FIELDS)))
+        self._pending.append(("INSERT OR REPLACE INTO queries VALUES (?, ?, ?)", (key, metadata['id'], metadata['cached_at'])))
+        if data.get('url'): self.put_stream(metadata['id'], data['url'])
+
+    def get_isrc(self, isrc: str) -> Optional[dict]:
+        """Vídeo já escolhido antes para este ISRC; dispensa a busca no YouTube."""
+        data = self._isrc.get(isrc)
+        if data: data = dict(data)
+        else:
+            row = self.db.execute(
+                "SELECT v.video_id, v.title, v.duration, v.thumbnail, v.webpage_url FROM isrc i "
+                "JOIN videos v ON v.video_id = i.video_id WHERE i.isrc = ?", (isrc,)).fetchone()
+            if not row: return None
+            data = dict(zip(self.METADATA_FIELDS, row))
+        url = self.get_stream(data['id'])
+        if url: data['url'] = url
+        return data
+
+    def put_isrc(self, isrc: str, data: dict):
+        self._isrc[isrc] = {field: data.get(field) for field in self.METADATA_FIELDS}
+        self._pending.append(("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)", tuple(data.get(f) for f in self.METADATA_FIELDS)))
+        self._pending.append(("INSERT OR REPLACE INTO isrc VALUES (?, ?)", (isrc, data['id'])))
+
+    def get_stream(self, video_id: str) -> Optional[str]:
+        entry = self._streams.get(video_id)
+        if entry is None:
+            entry = self.db.execute("SELECT url, expires_at FROM streams WHERE video_id = ?", (video_id,)).fetchone()
+            if not entry: return None
+            self._streams[video_id] = entry
+        url, expires_at = entry
+        if time.time() >= expires_at:
+            self._streams.pop(video_id, None); return None
+        return url
+
+    def put_stream(self, video_id: str, url: str):
+        entry = (url, stream_url_expiry(url))
+        self._streams[video_id] = entry
+        self._pending.append(("INSERT OR REPLACE INTO streams VALUES (?, ?, ?)", (video_id, *entry)))
+
+    def get_loudness(self, video_id: str) -> Optional[float]:
+        lufs = self._loudness.get(video_id)
+        if lufs is None:
+            row = self.db.execute("SELECT lufs FROM loudness WHERE video_id = ?", (video_id,)).fetchone()
+            if not row: return None
+            lufs = self._loudness[video_id] = row[0]
+        return lufs
+
+    def put_loudness(self, video_id: str, lufs: float):
+        self._loudness[video_id] = lufs
+        self._pending.append(("INSERT OR REPLACE INTO loudness VALUES (?, ?)", (video_id, lufs)))
+
+def cgroup_cpu_limit() -> float:
+    # Quantas CPUs o container pode usar (cota / período do cgroup); sem cota, todas as da máquina.
+    for quota_path, period_path in (('/sys/fs/cgroup/cpu.max', None), ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')):
+        try:
+            with open(quota_path) as f: values = f.read().split()
+            if period_path:
+                with open(period_path) as f: values.append(f.read().strip())
+            if values[0] not in ('max', '-1'): return int(values[0]) / int(values[1])
+            break
+        except (OSError, ValueError, IndexError): continue
+    return float(os.cpu_count() or 1)
+
+def read_cpu_times() -> Optional[tuple]:
+    """(CPU usada, CPU disponível), contadores acumulados; a carga é a razão entre as variações.
+
+    No container vale o cgroup (cpu.stat no v2, cpuacct no v1): o /proc/stat mostra a máquina inteira,
+    e um container no limite da cota pareceria ocioso. O /proc/stat fica só para quando não há cgroup.
+    """
+    now = time.monotonic()
+    try:
+        with open('/sys/fs/cgroup/cpu.stat') as f:
+            for line in f:
+                if line.startswith('usage_usec '): return int(line.split()[1]) / 1e6, now * cgroup_cpu_limit()
+    except (OSError, ValueError): pass
+    try:
+        with open('/sys/fs/cgroup/cpuacct/cpuacct.usage') as f: return int(f.read()) / 1e9, now * cgroup_cpu_limit()
+    except (OSError, ValueError): pass
+    try:
+        # Em jiffies, somando todas as CPUs; ocioso = idle + iowait.
+        with open('/proc/stat') as f: values = [int(v) for v in f.readline().split()[1:]]
+        return sum(values) - values[3] - values[4], sum(values)
+    except (OSError, ValueError, IndexError): return None
+
+def memory_usage_mb() -> Optional[float]:
+    # Prefere o uso do cgroup (o que o container realmente cobra, FFmpegs incluídos); senão o RSS do processo.
+    for path in ('/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory/memory.usage_in_bytes'):
+        try:
+            with open(path) as f: return int(f.read()) / (1024 * 1024)
+        except (OSError, ValueError): continue
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'): return int(line.split()[1]) / 1024
+    except (OSError, ValueError): pass
+    return None
+
+def count_ffmpeg_children() -> Optional[int]:
+    try:
+        pid = str(os.getpid()); count = 0
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit(): continue
+            try:
+                with open(f'/proc/{entry}/stat') as f: stat = f.read()
+            except OSError: continue
+            # Formato: pid (comm) estado ppid ...
+            comm = stat[stat.find('(') + 1:stat.rfind(')')]; ppid = stat[stat.rfind(')') + 2:].split()[1]
+            if comm == 'ffmpeg' and ppid == pid: count += 1
+        return count
+    except OSError: return None
+
+class AdmissionRefused(Exception):
+    pass
+
+class AdmissionController:
+    """Limite global de sessões de voz: número de sessões, CPU e memória.
+
+    Pedidos de sessão nova esperam numa fila FIFO enquanto não houver folga; sessões existentes
+    nunca são afetadas. Com a CPU acima do orçamento, as buscas também esperam, deixando a CPU
+    para o encode de quem já está ouvindo.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, session_count, max_sessions: int = MAX_VOICE_SESSIONS,
+                 cpu_budget: float = CPU_BUDGET_PERCENT, rss_budget_mb: int = RSS_BUDGET_MB):
+        self.session_count = session_count; self.max_sessions = max_sessions
+        self.cpu_budget = cpu_budget; self.rss_budget_mb = rss_budget_mb
+        self.cpu_percent: Optional[float] = None; self.rss_mb: Optional[float] = None; self.ffmpeg_processes: Optional[int] = None
+        self.connecting = 0 # Sessões admitidas que ainda não apareceram em bot.voice_clients
+        self.waiters: deque = deque(); self.refused = 0
+        self._last_cpu = read_cpu_times()
+        self.sample_task = loop.create_task(self._sample_loop())
+
+    async def _sample_loop(self):
+        while True:
+            await asyncio.sleep(ADMISSION_SAMPLE_INTERVAL)
+            # A varredura do /proc cresce com o número de processos da máquina: roda numa thread, fora do event loop.
+            try: await asyncio.get_running_loop().run_in_executor(None, self._sample)
+            except Exception as e: logger.warning(f"Falha ao medir a carga do sistema: {e}")
+            self.wake()
+
+    def _sample(self):
+        cpu = read_cpu_times()
+        if cpu and self._last_cpu and cpu[1] > self._last_cpu[1]:
+            self.cpu_percent = min(100.0, 100 * (cpu[0] - self._last_cpu[0]) / (cpu[1] - self._last_cpu[1]))
+        elif not cpu and hasattr(os, 'getloadavg'): self.cpu_percent = 100 * os.getloadavg()[0] / (os.cpu_count() or 1)
+        self._last_cpu = cpu
+        self.rss_mb = memory_usage_mb(); self.ffmpeg_processes = count_ffmpeg_children()
+
+    def over_budget(self) -> Optional[str]:
+        """Motivo pelo qual uma sessão nova não cabe agora, ou None."""
+        if self.session_count() + self.connecting >= self.max_sessions: return f"{self.max_sessions} sessões de voz ativas"
+        if self.cpu_percent is not None and self.cpu_percent > self.cpu_budget: return f"CPU em {self.cpu_percent:.0f}%"
+        if self.rss_mb is not None and self.rss_mb > self.rss_budget_mb: return f"memória em {self.rss_mb:.0f} MB"
+        return None
+
+    async def acquire(self):
+        """Reserva uma sessão nova; levanta AdmissionRefused se não houver folga dentro de ADMISSION_WAIT."""
+        if not self.waiters and not self.over_budget():
+            self.connecting += 1; return
+        future = asyncio.get_running_loop().create_future(); self.waiters.append(future)
+        try: await asyncio.wait_for(future, ADMISSION_WAIT)
+        except asyncio.TimeoutError:
+            self.refused += 1
+            raise AdmissionRefused(f"o bot está no limite de capacidade ({self.over_budget() or 'fila de espera cheia'}), tente novamente em alguns minutos")
+        finally:
+            if future in self.waiters: self.waiters.remove(future)
+
+    def release(self):
+        # Chamado depois da tentativa de conexão: a sessão passa a contar por bot.voice_clients (ou não existe).
+        self.connecting = max(0, self.connecting - 1); self.wake()
+
+    def wake(self):
+        # Admite os primeiros da fila enquanto houver folga; a reserva é feita aqui para não admitir dois na mesma vaga.
+        while self.waiters and not self.over_budget():
+            future = self.waiters.popleft()
+            if not future.done(): self.connecting += 1; future.set_result(None)
+
+    async def search_gate(self):
+        waited = 0.0
+        while self.cpu_percent is not None and self.cpu_percent > self.cpu_budget and waited < SEARCH_BACKOFF_MAX:
+            await asyncio.sleep(1); waited += 1
+
+    def describe(self) -> str:
+        def fmt(value, unit): return f"{value:.0f}{unit}" if value is not None else "?"
+        return (f"Sessões de voz: `{self.session_count()}/{self.max_sessions}`\n"
+                f"Processos FFmpeg: `{self.ffmpeg_processes if self.ffmpeg_processes is not None else '?'}`\n"
+                f"CPU: `{fmt(self.cpu_percent, '%')} / {self.cpu_budget:.0f}%`\n"
+                f"Memória: `{fmt(self.rss_mb, ' MB')} / {self.rss_budget_mb} MB`\n"
+                f"Aguardando vaga: `{len(self.waiters)}` | Recusadas: `{self.refused}`")
+
+class RateLimiter:
+    """Token bucket compartilhado entre servidores para não exceder a tolerância do YouTube."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate; self.capacity = burst; self.tokens = float(burst)
+        self.updated = time.monotonic(); self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# --- Fila de Reprodução ---
+class _QueueNode:
+    __slots__ = ('item', 'round', 'priority', 'size', 'max_round', 'left', 'right')
+    def __init__(self, item, round_: int):
+        self.item = item; self.round = round_; self.priority = random.random()
+        self.size = 1; self.max_round = round_; self.left = None; self.right = None
+
+def _node_size(node: Optional[_QueueNode]) -> int:
+    return node.size if node else 0
+
+def _node_update(node: _QueueNode):
+    node.size = 1 + _node_size(node.left) + _node_size(node.right)
+    node.max_round = max(node.round, node.left.max_round if node.left else node.round, node.right.max_round if node.right else node.round)
+
+def _node_split(node: Optional[_QueueNode], k: int) -> tuple:
+    # Divide em (primeiros k itens, restante).
+    if not node: return None, None
+    if _node_size(node.left) >= k:
+        left, node.left = _node_split(node.left, k); _node_update(node); return left, node
+    node.right, right = _node_split(node.right, k - _node_size(node.left) - 1); _node_update(node); return node, right
+
+def _node_merge(a: Optional[_QueueNode], b: Optional[_QueueNode]) -> Optional[_QueueNode]:
+    if not a or not b: return a or b
+    if a.priority > b.priority:
+        a.right = _node_merge(a.right, b); _node_update(a); return a
+    b.left = _node_merge(a, b.left); _node_update(b); return b
+
+def _node_items(node: Optional[_QueueNode], out: list):
+    stack = []
+    while stack or node:
+        while node: stack.append(node); node = node.left
+        node = stack.pop(); out.append(node.item); node = node.right
+
+class PlaybackQueue:
+    """Fila de reprodução indexada (treap implícita): inserir, remover e mover em O(log n).
+
+    Cada música recebe uma "rodada" por quem pediu; com `fair` ativo, a música nova entra antes da
+    primeira de rodada maior, intercalando os pedidos de usuários diferentes. O limite é só indicativo.
+    """
+    def __init__(self, soft_limit: int = QUEUE_SOFT_LIMIT, fair: bool = True):
+        self.soft_limit = soft_limit; self.fair = fair
+        self._root: Optional[_QueueNode] = None
+        self._served_round = 0; self._last_round: Dict[int, int] = {}
+        self._not_empty = asyncio.Event()
+
+    def __len__(self) -> int: return _node_size(self._root)
+    def qsize(self) -> int: return len(self)
+    def empty(self) -> bool: return self._root is None
+    @property
+    def full(self) -> bool: return len(self) >= self.soft_limit
+
+    def _insert_node(self, index: int, node: _QueueNode):
+        left, right = _node_split(self._root, index)
+        self._root = _node_merge(_node_merge(left, node), right)
+        self._not_empty.set()
+
+    def _remove_node(self, index: int) -> _QueueNode:
+        if not 0 <= index < len(self): raise IndexError("posição fora da fila")
+        left, rest = _node_split(self._root, index)
+        node, right = _node_split(rest, 1)
+        self._root = _node_merge(left, right)
+        return node
+
+    def _first_after_round(self, round_: int) -> int:
+        node = self._root; index = 0
+        while node:
+            if node.left and node.left.max_round > round_: node = node.left
+            elif node.round > round_: return index + _node_size(node.left)
+            else: index += _node_size(node.left) + 1; node = node.right
+        return index
+
+    def _round_at(self, index: int) -> int:
+        return self._served_round if index <= 0 else self._get_node(index - 1).round
+
+    def _get_node(self, index: int) -> _QueueNode:
+        if not 0 <= index < len(self): raise IndexError("posição fora da fila")
+        node = self._root
+        while True:
+            left_size = _node_size(node.left)
+            if index < left_size: node = node.left
+            elif index == left_size: return node
+            else: index -= left_size + 1; node = node.right
+
+    def put(self, song: 'Song', fair: Optional[bool] = None):
+        """Adiciona uma música; nunca bloqueia."""
+        if self.fair if fair is None else fair:
+            requester_id = song.requester.id
+            round_ = max(self._last_round.get(requester_id, 0), self._served_round) + 1
+            self._last_round[requester_id] = round_
+            self._insert_node(self._first_after_round(round_), _QueueNode(song, round_))
+        else: self.append(song)
+
+    def append(self, song: 'Song'):
+        round_ = max(self._root.max_round if self._root else 0, self._served_round)
+        self._insert_node(len(self), _QueueNode(song, round_))
+
+    def insert(self, index: int, song: 'Song'):
+        index = max(0, min(index, len(self)))
+        self._insert_node(index, _QueueNode(song, self._round_at(index)))
+
+    def pop(self, index: int = 0) -> 'Song':
+        node = self._remove_node(index)
+        if index == 0: self._served_round = max(self._served_round, node.round)
+        return node.item
+
+    def move(self, source: int, destination: int) -> 'Song':
+        node = self._remove_node(source)
+        destination = max(0, min(destination, len(self)))
+        node.left = node.right = None; node.round = self._round_at(destination); _node_update(node)
+        self._insert_node(destination, node)
+        return node.item
+
+    def peek(self, index: int = 0) -> Optional['Song']:
+        return self._get_node(index).item if 0 <= index < len(self) else None
+
+    def slice(self, start: int, stop: int) -> List['Song']:
+        """Cópia das posições [start, stop) em O(log n + k), para paginação."""
+        start = max(0, start); stop = min(stop, len(self))
+        if start >= stop: return []
+        left, rest = _node_split(self._root, start)
+        middle, right = _node_split(rest, stop - start)
+        items: list = []; _node_items(middle, items)
+        self._root = _node_merge(left, _node_merge(middle, right))
+        return items
+
+    def shuffle(self):
+        items: list = []; _node_items(self._root, items)
+        random.shuffle(items)
+        self._root = None; self._last_round.clear()
+        for song in items: self._root = _node_merge(self._root, _QueueNode(song, self._served_round))
+
+    def clear(self):
+        self._root = None; self._last_round.clear()
+
+    async def get(self) -> 'Song':
+        """Espera a próxima música (equivalente ao asyncio.Queue.get)."""
+        while self._root is None:
+            self._not_empty.clear(); await self._not_empty.wait()
+        return self.pop(0)
 
 class LoopState(Enum):
     NONE = 0; SONG = 1; QUEUE = 2
 
 class Song:
+    # Guarda apenas a identidade estável do vídeo; a URL de stream é resolvida sob demanda.
     def __init__(self, data: dict, requester: discord.Member):
-        self.source_url: str = data['url']; self.title: str = data.get('title', 'Título Desconhecido')
-        self.thumbnail: Optional[str] = data.get('thumbnail'); self.duration: int = int(data.get('duration', 0))
-        self.requester: discord.Member = requester; self.webpage_url: str = data.get('webpage_url', '')
+        self.video_id: Optional[str] = data.get('id'); self.title: str = data.get('title', 'Título Desconhecido')
+        self.thumbnail: Optional[str] = data.get('thumbnail'); self.duration: int = int(data.get('duration') or 0)
+        self.requester: discord.Member = requester; self.webpage_url: str = data.get('webpage_url') or ''
+        if not self.webpage_url and self.video_id: self.webpage_url = f"https://www.youtube.com/watch?v={self.video_id}"
+        self.source_url: Optional[str] = None; self.stream_expires_at: float = 0.0
+        self.refresh_task: Optional[asyncio.Task] = None; self.resume_at: float = 0.0; self.resume_attempts: int = 0
+        if data.get('url'): self.set_stream(data['url'])
+
+    def to_identity(self) -> dict:
+        # O que é persistido entre reinícios: nunca a URL de stream, que expira.
+        return {'id': self.video_id, 'title': self.title, 'duration': self.duration, 'thumbnail': self.thumbnail,
+                'webpage_url': self.webpage_url, 'requester': self.requester.id}
+
+    def set_stream(self, url: str):
+        self.source_url = url; self.stream_expires_at = stream_url_expiry(url)
+
+    @property
+    def stream_valid(self) -> bool:
+        # A URL precisa continuar válida durante toda a música, não só no instante em que o FFmpeg abre.
+        return bool(self.source_url) and time.time() + self.duration < self.stream_expires_at
+
+class StateJournal:
+    """Estado de reprodução por servidor em disco: journal append-only + snapshot compactado.
+
+    Cada registro do journal é o snapshot de um servidor, só a posição da música atual, ou uma alteração
+    da lista de faixas da playlist a buscar (que fica fora do snapshot: é grande e muda por pedaços);
+    reaplicar o journal sobre o snapshot reconstrói o último estado conhecido. As alterações da lista não são
+    idempotentes, então todo registro leva um número de sequência e o snapshot guarda o último que já contém:
+    se o processo cair entre a troca do snapshot e a limpeza do journal, os registros antigos são ignorados.
+    """
+    def __init__(self, snapshot_path: str = STATE_SNAPSHOT_FILE, journal_path: str = STATE_JOURNAL_FILE):
+        self.snapshot_path = snapshot_path; self.journal_path = journal_path
+        self.closed = False; self._pending: List[str] = []; self.seq = 0
+        self.states: Dict[int, dict] = self._load()
+        self.journal_bytes = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+
+    def _load(self) -> Dict[int, dict]:
+        states: Dict[int, dict] = {}; snapshot_seq = 0
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f: data = json.load(f)
+            snapshot_seq = self.seq = data['seq']
+            states = {int(guild_id): snapshot for guild_id, snapshot in data['states'].items()}
+        except FileNotFoundError: pass
+        except (json.JSONDecodeError, KeyError, OSError) as e: logger.error(f"Erro ao carregar {self.snapshot_path}: {e}")
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try: record = json.loads(line)
+                    except json.JSONDecodeError: break # Última linha cortada por um crash: descarta o resto
+                    if record['seq'] <= snapshot_seq: continue # Já está no snapshot (crash no meio da compactação)
+                    self._apply(states, record); self.seq = record['seq']
+        except FileNotFoundError: pass
+        except OSError as e: logger.error(f"Erro ao ler {self.journal_path}: {e}")
+        return states
+
+    @staticmethod
+    def _apply(states: Dict[int, dict], record: dict):
+        guild_id = int(record['guild'])
+        if 'state' in record:
+            if record['state'] is None: states.pop(guild_id, None)
+            else: states[guild_id] = dict(record['state'], tracks=states.get(guild_id, {}).get('tracks', []))
+        elif guild_id not in states: return
+        elif 'position' in record: states[guild_id]['position'] = record['position']
+        elif 'tracks' in record: states[guild_id]['tracks'] = record['tracks']
+        else:
+            # Faixas novas entram no fim e as buscadas saem do começo, então a ordem entre as duas não importa.
+            tracks = states[guild_id]['tracks'] + record.get('appended', [])
+            states[guild_id]['tracks'] = tracks[record.get('consumed', 0):]
+
+    def _append(self, record: dict):
+        if self.closed: return
+        self.seq += 1; record['seq'] = self.seq
+        self._apply(self.states, record); self._pending.append(json.dumps(record, separators=(',', ':')))
+
+    def record(self, guild_id: int, snapshot: Optional[dict]): self._append({'guild': guild_id, 'state': snapshot})
+    def record_position(self, guild_id: int, position: float):
+        # Pausado (ou travado), a posição não muda: não há o que gravar.
+        if guild_id in self.states and self.states[guild_id].get('position') == round(position, 2): return
+        self._append({'guild': guild_id, 'position': round(position, 2)})
+    def record_tracks(self, guild_id: int, tracks: List[list]): self._append({'guild': guild_id, 'tracks': tracks})
+    def record_tracks_delta(self, guild_id: int, appended: List[list], consumed: int): self._append({'guild': guild_id, 'appended': appended, 'consumed': consumed})
+    def forget(self, guild_id: int):
+        if guild_id in self.states: self.record(guild_id, None)
+
+    def prepare_flush(self) -> tuple:
+        """Serializa no event loop o que for gravado; a escrita em si (write_flush) roda numa thread."""
+        journal_text = "".join(line + "\n" for line in self._pending); self._pending = []
+        self.journal_bytes += len(journal_text.encode('utf-8'))
+        snapshot_text = None
+        if self.journal_bytes > STATE_COMPACT_BYTES:
+            snapshot_text = json.dumps({'seq': self.seq, 'states': self.states}, separators=(',', ':')); self.journal_bytes = 0
+        return journal_text, snapshot_text
+
+    def write_flush(self, journal_text: str, snapshot_text: Optional[str]):
+        try:
+            if journal_text:
+                with open(self.journal_path, 'a', encoding='utf-8') as f: f.write(journal_text)
+            if snapshot_text is not None:
+                # Compactação: troca atômica do snapshot e só então zera o journal.
+                tmp_path = self.snapshot_path + ".tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f: f.write(snapshot_text)
+                os.replace(tmp_path, self.snapshot_path)
+                open(self.journal_path, 'w', encoding='utf-8').close()
+        except OSError as e: logger.error(f"Não foi possível gravar o estado de reprodução: {e}")
 
 class GuildState:
-    def __init__(self, loop: asyncio.AbstractEventLoop, cog_instance: 'MusicCog'):
-        self.cog_instance = cog_instance; self.loop = loop
-        self.song_queue = asyncio.Queue(maxsize=200)
-        self.play_next_song = asyncio.Event()
+    def __init__(self, loop: asyncio.AbstractEventLoop, cog_instance: 'MusicCog', guild_id: int):
+        self.cog_instance = cog_instance; self.loop = loop; self.guild_id = guild_id
+        self.song_queue = PlaybackQueue()
+        self.queue_changed = asyncio.Condition() # Notificado quando o player consome uma música da fila
+        self.play_next_song = asyncio.Event(); self.skip_requested: bool = False
         self.current_song: Optional[Song] = None; self.player_task: Optional[asyncio.Task] = None
         self.menu_message: Optional[discord.WebhookMessage] = None
-        self.volume: float = 0.5; self.loop_state: LoopState = LoopState.NONE
-        self.song_start_time: Optional[float] = None; self.playlist_mode: bool = False
+        self.volume: float = 1.0; self.loop_state: LoopState = LoopState.NONE; self.effects: List[str] = []
+        self.playlist_mode: bool = False
+        self.current_source: Optional[TrackedAudio] = None
+        self.prefetch_depth: int = PREFETCH_DEPTH_DEFAULT; self.prefetch_task: Optional[asyncio.Task] = None
+        self.warm_source: Optional[tuple] = None # (Song, AudioSource, volume) já conectado e aguardando a vez
         self.playlist_requester: Optional[discord.Member] = None
         self.playlist_total_tracks: int = 0; self.playlist_loaded_tracks: int = 0
-        self.playlist_tracks_to_search: List[str] = []; self.playlist_loader_task: Optional[asyncio.Task] = None
+        self.playlist_tracks_to_search: List[PlaylistTrack] = []; self.playlist_loader_task: Optional[asyncio.Task] = None
+        self.playlist_fetch_task: Optional[asyncio.Task] = None; self.playlist_fetch_done: bool = True
+        # Mudanças na lista a buscar desde o último registro no journal (a lista inteira só é regravada se for trocada).
+        self.playlist_tracks_replaced: bool = False; self.playlist_tracks_appended: List[PlaylistTrack] = []; self.playlist_tracks_consumed: int = 0
+        self.menu_render_task: Optional[asyncio.Task] = None; self.menu_dirty: bool = False
+        self.menu_render_delay: float = MENU_RENDER_DELAY; self.menu_last_render: Optional[tuple] = None
 
     def reset_playlist_state(self):
         self.playlist_mode = False; self.playlist_requester = None; self.playlist_total_tracks = 0; self.playlist_loaded_tracks = 0
-        self.playlist_tracks_to_search.clear()
+        self.set_playlist_tracks([])
         if self.playlist_loader_task and not self.playlist_loader_task.done(): self.playlist_loader_task.cancel()
-        while not self.song_queue.empty():
-            try: self.song_queue.get_nowait()
-            except asyncio.QueueEmpty: continue
+        if self.playlist_fetch_task and not self.playlist_fetch_task.done(): self.playlist_fetch_task.cancel()
+        self.playlist_fetch_done = True
+        self.song_queue.clear()
         logger.info("Estado da playlist e fila de músicas foram resetados.")
 
+    def mark_dirty(self):
+        # O próximo registro do journal grava o snapshot deste servidor (fila, volume, música atual...).
+        self.cog_instance.dirty_states.add(self.guild_id)
+
+    def set_playlist_tracks(self, tracks: List[PlaylistTrack]):
+        self.playlist_tracks_to_search = tracks; self.mark_dirty()
+        self.playlist_tracks_replaced = True; self.playlist_tracks_appended = []; self.playlist_tracks_consumed = 0
+
+    def add_playlist_tracks(self, tracks: List[PlaylistTrack]):
+        self.playlist_tracks_to_search.extend(tracks)
+        if not self.playlist_tracks_replaced: self.playlist_tracks_appended.extend(tracks)
+
+    def take_playlist_tracks(self, count: int) -> List[PlaylistTrack]:
+        tracks = self.playlist_tracks_to_search[:count]; del self.playlist_tracks_to_search[:count]
+        if not self.playlist_tracks_replaced: self.playlist_tracks_consumed += len(tracks)
+        return tracks
+
     async def update_menu(self):
+        # Só marca o menu como desatualizado; _render_menu agrupa as chamadas numa única edição.
         if not self.menu_message: return
-        embed = self.cog_instance.build_player_embed(self)
-        view = PlayerView(self.cog_instance, self)
-        try:
-            await self.menu_message.edit(embed=embed, view=view)
-        except (discord.NotFound, discord.HTTPException) as e:
-            logger.warning(f"Não foi possível editar a mensagem do menu: {e}"); self.menu_message = None
+        self.menu_dirty = True
+        if not self.menu_render_task or self.menu_render_task.done():
+            self.menu_render_task = self.loop.create_task(self._render_menu())
+
+    async def _render_menu(self):
+        while self.menu_dirty and self.menu_message:
+            await asyncio.sleep(self.menu_render_delay)
+            if not self.menu_message: return
+            self.menu_dirty = False
+            embed = self.cog_instance.build_player_embed(self)
+            view = PlayerView(self.cog_instance, self)
+            payload = json.dumps([embed.to_dict(), view.to_components()], sort_keys=True, default=str)
+            render = (self.menu_message.id, hashlib.sha1(payload.encode()).hexdigest())
+            if render == self.menu_last_render: continue # Nada mudou na tela: economiza a requisição
+            started = time.monotonic()
+            try:
+                await self.menu_message.edit(embed=embed, view=view)
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.menu_render_delay = min(self.menu_render_delay * 2, MENU_RENDER_MAX_DELAY); self.menu_dirty = True
+                    logger.warning(f"Edição do menu limitada pelo Discord. Próxima tentativa em {self.menu_render_delay:.0f}s."); continue
+                logger.warning(f"Não foi possível editar a mensagem do menu: {e}"); self.menu_message = None; self.mark_dirty(); return
+            self.menu_last_render = render
+            # Backoff adaptativo: edições lentas indicam que estamos esperando no rate limiter do canal.
+            if time.monotonic() - started > MENU_SLOW_EDIT: self.menu_render_delay = min(self.menu_render_delay * 2, MENU_RENDER_MAX_DELAY)
+            else: self.menu_render_delay = max(MENU_RENDER_DELAY, self.menu_render_delay / 2)
 
 # --- Views Paginadas para o Menu Admin ---
 class AdminQueuePaginator(ui.View):
     def __init__(self, author: discord.Member, state: GuildState, cog: 'MusicCog'):
         super().__init__(timeout=180)
         self.author = author; self.state = state; self.cog = cog
-        self.queue_list = list(state.song_queue._queue)
         self.page = 0
-        self.total_pages = max(0, (len(self.queue_list) - 1) // ADMIN_QUEUE_ITEMS_PER_PAGE)
+        self.total_pages = max(0, (len(state.song_queue) - 1) // ADMIN_QUEUE_ITEMS_PER_PAGE)
         self.update_view()
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
@@ -140,7 +1289,7 @@ class AdminQueuePaginator(ui.View):
         embed = discord.Embed(title=f"Admin: Pular Fila (Página {self.page + 1}/{self.total_pages + 1})", color=discord.Color.blurple())
         start_index = self.page * ADMIN_QUEUE_ITEMS_PER_PAGE
         end_index = start_index + ADMIN_QUEUE_ITEMS_PER_PAGE
-        page_songs = self.queue_list[start_index:end_index]
+        page_songs = self.state.song_queue.slice(start_index, end_index)
 
         if not page_songs:
             embed.description = "Não há mais músicas para exibir nesta página."
@@ -157,7 +1306,7 @@ class AdminQueuePaginator(ui.View):
         self.clear_items()
         start_index = self.page * ADMIN_QUEUE_ITEMS_PER_PAGE
         end_index = start_index + ADMIN_QUEUE_ITEMS_PER_PAGE
-        page_songs = self.queue_list[start_index:end_index]
+        page_songs = self.state.song_queue.slice(start_index, end_index)
         
         for i, song in enumerate(page_songs):
             button = ui.Button(label=f"#{i + 1 + start_index}", style=discord.ButtonStyle.secondary, custom_id=f"select_{i + start_index}")
@@ -176,16 +1325,13 @@ class AdminQueuePaginator(ui.View):
         await interaction.response.defer()
         selected_index = int(interaction.data['custom_id'].split('_')[1])
         
-        # Usa a deque interna para manipulação atômica e eficiente
-        queue_deque = self.state.song_queue._queue
-        song_to_move = queue_deque[selected_index]
-        
-        del queue_deque[selected_index]
-        queue_deque.insert(0, song_to_move)
+        if selected_index >= len(self.state.song_queue):
+            return await interaction.followup.send("A fila mudou desde que este menu foi aberto. Abra-o novamente.", ephemeral=True)
+        song_to_move = self.state.song_queue.move(selected_index, 0); self.state.mark_dirty()
 
         vc = interaction.guild.voice_client
         if vc and (vc.is_playing() or vc.is_paused()):
-            vc.stop()
+            self.state.skip_requested = True; vc.stop()
             
         await interaction.followup.send(f"✅ **{song_to_move.title}** será a próxima a tocar.", ephemeral=True, delete_after=10)
         await interaction.message.delete()
@@ -211,6 +1357,7 @@ class StopPlaylistView(ui.View):
         await interaction.response.edit_message(content="Playlist parada. Agora você pode adicionar novas músicas.", view=None)
 
 class PlayerView(ui.View):
+    # Os botões têm custom_id fixo: sem isso cada instância ganha ids aleatórios e o hash do menu nunca se repete.
     def __init__(self, cog: 'MusicCog', state: GuildState):
         super().__init__(timeout=None); self.cog = cog; self.state = state
         self._update_buttons()
@@ -225,7 +1372,7 @@ class PlayerView(ui.View):
         elif self.state.loop_state == LoopState.SONG: loop_btn.label, loop_btn.style = "Loop Msc", discord.ButtonStyle.primary
         else: loop_btn.label, loop_btn.style = "Loop Fila", discord.ButtonStyle.primary
 
-    @ui.button(label="Pausar", style=discord.ButtonStyle.secondary, emoji="⏸️", row=0)
+    @ui.button(label="Pausar", style=discord.ButtonStyle.secondary, emoji="⏸️", row=0, custom_id="player:pause")
     async def pause_resume(self, interaction: discord.Interaction, button: ui.Button):
         vc = interaction.guild.voice_client
         if not vc: return await interaction.response.send_message("O bot não está tocando nada.", ephemeral=True)
@@ -233,42 +1380,40 @@ class PlayerView(ui.View):
         else: vc.pause(); await interaction.response.send_message("⏸️ Música pausada!", ephemeral=True, delete_after=5)
         self._update_buttons(); await interaction.message.edit(view=self)
 
-    @ui.button(label="Pular", style=discord.ButtonStyle.secondary, emoji="⏭️", row=0)
+    @ui.button(label="Pular", style=discord.ButtonStyle.secondary, emoji="⏭️", row=0, custom_id="player:skip")
     async def skip(self, interaction: discord.Interaction, button: ui.Button):
         vc = interaction.guild.voice_client
         if not vc or not (vc.is_playing() or vc.is_paused()): return await interaction.response.send_message("Não há música para pular.", ephemeral=True)
+        self.state.skip_requested = True
         vc.stop(); await interaction.response.send_message("⏭️ Música pulada!", ephemeral=True, delete_after=5)
 
-    @ui.button(label="Parar", style=discord.ButtonStyle.danger, emoji="⏹️", row=0)
+    @ui.button(label="Parar", style=discord.ButtonStyle.danger, emoji="⏹️", row=0, custom_id="player:stop")
     async def stop(self, interaction: discord.Interaction, button: ui.Button):
         await self.cog.stop_player(interaction)
 
-    @ui.button(label="Loop Off", style=discord.ButtonStyle.secondary, emoji="🔁", row=0)
+    @ui.button(label="Loop Off", style=discord.ButtonStyle.secondary, emoji="🔁", row=0, custom_id="player:loop")
     async def loop(self, interaction: discord.Interaction, button: ui.Button):
         states = [LoopState.NONE, LoopState.SONG, LoopState.QUEUE]
         messages = ["🔁 Loop desativado.", "🔂 Loop da música ativado.", "🔁 Loop da fila ativado."]
         next_index = (self.state.loop_state.value + 1) % len(states)
-        self.state.loop_state = states[next_index]
+        self.state.loop_state = states[next_index]; self.state.mark_dirty()
         await interaction.response.send_message(messages[next_index], ephemeral=True, delete_after=10)
         self._update_buttons(); await self.state.update_menu()
     
-    @ui.button(label="Limpar Fila", style=discord.ButtonStyle.danger, emoji="🗑️", row=1)
+    @ui.button(label="Limpar Fila", style=discord.ButtonStyle.danger, emoji="🗑️", row=1, custom_id="player:clear")
     async def clear_queue(self, interaction: discord.Interaction, button: ui.Button):
         if self.state.song_queue.empty() and not self.state.playlist_tracks_to_search:
             return await interaction.response.send_message("A fila já está vazia.", ephemeral=True)
         if self.state.playlist_mode: self.state.reset_playlist_state()
-        else:
-             while not self.state.song_queue.empty():
-                try: self.state.song_queue.get_nowait()
-                except asyncio.QueueEmpty: continue
+        else: self.state.song_queue.clear(); self.state.mark_dirty()
         await self.state.update_menu()
         await interaction.response.send_message("🗑️ Fila de músicas limpa!", ephemeral=True)
 
-    @ui.button(label="Fila", style=discord.ButtonStyle.primary, emoji="📜", row=1)
+    @ui.button(label="Fila", style=discord.ButtonStyle.primary, emoji="📜", row=1, custom_id="player:queue")
     async def queue(self, interaction: discord.Interaction, button: ui.Button):
         await self.cog.show_queue(interaction, ephemeral=True)
     
-    @ui.button(label="Admin: Pular Fila", style=discord.ButtonStyle.blurple, emoji="🔀", row=2)
+    @ui.button(label="Admin: Pular Fila", style=discord.ButtonStyle.blurple, emoji="🔀", row=2, custom_id="player:admin")
     async def jump_queue(self, interaction: discord.Interaction, button: ui.Button):
         if not interaction.user.guild_permissions.manage_guild:
             return await interaction.response.send_message("🚫 Apenas administradores podem usar esta função.", ephemeral=True)
@@ -282,7 +1427,13 @@ class PlayerView(ui.View):
 class MusicCog(commands.Cog, name="Music"):
     def __init__(self, bot: commands.Bot):
         self.bot = bot; self.guild_states: Dict[int, GuildState] = {}
-        self.process_executor = ProcessPoolExecutor(max_workers=2); self.spotify_client = None
+        self.extractors = ExtractorPool(self.bot.loop); self.spotify_client = None
+        self.state_journal = StateJournal(); self.dirty_states: set = set(); self._restored = False
+        self.journal_task = self.bot.loop.create_task(self._journal_loop())
+        self.search_cache_task = self.bot.loop.create_task(self._search_cache_loop())
+        self.search_cache = SearchCache(); self.audio_cache = AudioCache(); self.search_rate_limiter = RateLimiter(SEARCH_RATE_PER_SECOND, SEARCH_RATE_BURST)
+        self.loudness_pending: set = set(); self.loudness_workers = ExtractorPool(self.bot.loop, LOUDNESS_CONCURRENCY)
+        self.admission = AdmissionController(self.bot.loop, lambda: len(self.bot.voice_clients))
         client_id = os.getenv("SPOTIPY_CLIENT_ID"); client_secret = os.getenv("SPOTIPY_CLIENT_SECRET")
         if client_id and client_secret:
             try:
@@ -292,16 +1443,158 @@ class MusicCog(commands.Cog, name="Music"):
             except Exception as e: logger.error(f"Falha ao inicializar o cliente Spotify: {e}")
         else: logger.warning("Credenciais do Spotify não encontradas.")
 
-    def cog_unload(self): self.process_executor.shutdown(wait=True)
+    def cog_unload(self):
+        # Grava o estado final (inclusive a posição atual) antes de desligar, para retomar no próximo start.
+        self.journal_task.cancel(); self.search_cache_task.cancel(); self._record_states()
+        self.state_journal.write_flush(*self.state_journal.prepare_flush()); self.state_journal.closed = True
+        self.extractors.shutdown(); self.loudness_workers.shutdown(); self.search_cache.close(); self.admission.sample_task.cancel()
+
+    async def _connect_voice(self, channel: discord.VoiceChannel) -> discord.VoiceClient:
+        """Conecta a um canal de voz passando pelo controle de admissão."""
+        await self.admission.acquire()
+        try: return await channel.connect()
+        finally: self.admission.release()
+
     def get_guild_state(self, guild_id: int) -> GuildState:
-        if guild_id not in self.guild_states: self.guild_states[guild_id] = GuildState(self.bot.loop, self)
+        if guild_id not in self.guild_states: self.guild_states[guild_id] = GuildState(self.bot.loop, self, guild_id)
         return self.guild_states[guild_id]
 
+    # --- Persistência e Restauração ---
+    def _playback_position(self, state: GuildState) -> float:
+        return state.current_source.position if state.current_source else 0.0
+
+    def _player_active(self, state: GuildState, vc: Optional[discord.VoiceClient]) -> bool:
+        # vc.source continua apontando para a última fonte depois que a música acaba; o que vale é o player estar ativo.
+        return bool(vc and state.current_song and state.current_source) and (vc.is_playing() or vc.is_paused())
+
+    async def _restart_source(self, state: GuildState, vc: discord.VoiceClient, start_at: float) -> bool:
+        """Troca a fonte da música atual por um novo FFmpeg a partir de `start_at`, sem passar pelo 'after'."""
+        song = state.current_song
+        if not self._player_active(state, vc): return False
+        url = await self._playable_url(song)
+        if not url: return False
+        source = self._create_source(state, song, url, start_at=start_at)
+        # A música pode ter acabado (ou mudado) enquanto a URL era resolvida: a fonte nova iria para um player morto.
+        if state.current_song is not song or not self._player_active(state, vc):
+            source.cleanup(); return False
+        paused = vc.is_paused(); old_source = vc.source
+        state.current_source = source
+        vc.source = source # O setter do discord.py pausa, troca e sempre retoma
+        if paused: vc.pause()
+        old_source.cleanup()
+        return True
+
+    def _create_source(self, state: GuildState, song: Song, url: str, start_at: float = 0.0) -> TrackedAudio:
+        # Tudo o que é do servidor (volume, efeitos) ou da música (loudness) vira parte do mesmo FFmpeg.
+        return create_audio_source(url, state.volume, start_at=start_at, shared_key=song.video_id if not start_at else None,
+                                   gain_db=self._track_gain(song), effects=state.effects)
+
+    def _snapshot_state(self, state: GuildState) -> Optional[dict]:
+        guild = self.bot.get_guild(state.guild_id)
+        vc = guild.voice_client if guild else None
+        if not vc or not vc.channel: return None
+        snapshot = {
+            'voice_channel': vc.channel.id, 'volume': state.volume, 'loop': state.loop_state.name, 'prefetch_depth': state.prefetch_depth, 'effects': state.effects,
+            'menu': [state.menu_message.channel.id, state.menu_message.id] if state.menu_message else None,
+            'current': state.current_song.to_identity() if state.current_song else None, 'position': self._playback_position(state),
+            'queue': [song.to_identity() for song in state.song_queue.slice(0, len(state.song_queue))],
+        }
+        if state.playlist_mode and state.playlist_requester:
+            # As faixas a buscar vão em registros próprios (_record_playlist_tracks), não a cada snapshot.
+            snapshot['playlist'] = {'requester': state.playlist_requester.id, 'total': state.playlist_total_tracks, 'loaded': state.playlist_loaded_tracks}
+        return snapshot
+
+    def _record_playlist_tracks(self, state: GuildState):
+        if state.playlist_tracks_replaced: self.state_journal.record_tracks(state.guild_id, [track.to_list() for track in state.playlist_tracks_to_search])
+        elif state.playlist_tracks_appended or state.playlist_tracks_consumed:
+            self.state_journal.record_tracks_delta(state.guild_id, [track.to_list() for track in state.playlist_tracks_appended], state.playlist_tracks_consumed)
+        state.playlist_tracks_replaced = False; state.playlist_tracks_appended = []; state.playlist_tracks_consumed = 0
+
+    def _record_states(self):
+        dirty, self.dirty_states = self.dirty_states, set()
+        for guild_id, state in self.guild_states.items():
+            if guild_id in dirty:
+                # Servidor que ainda não estava no journal: as deltas não teriam base, então a lista vai inteira.
+                if guild_id not in self.state_journal.states: state.playlist_tracks_replaced = True
+                self.state_journal.record(guild_id, self._snapshot_state(state))
+            elif state.current_song and state.current_source: self.state_journal.record_position(guild_id, self._playback_position(state))
+            self._record_playlist_tracks(state)
+
+    async def _search_cache_loop(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(SEARCH_CACHE_FLUSH_INTERVAL)
+            prune = time.monotonic() - last_prune >= SEARCH_CACHE_PRUNE_INTERVAL
+            if prune: last_prune = time.monotonic(); self.search_cache.prune_memory()
+            batch = self.search_cache.take_pending()
+            if batch or prune: await self.bot.loop.run_in_executor(None, self.search_cache.write, batch, prune)
+
+    async def _journal_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                self._record_states()
+                await self.bot.loop.run_in_executor(None, self.state_journal.write_flush, *self.state_journal.prepare_flush())
+            except Exception as e: logger.error(f"Erro ao gravar o estado de reprodução: {e}", exc_info=e)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self._restored: return # on_ready também dispara em reconexões
+        self._restored = True
+        for guild_id, snapshot in list(self.state_journal.states.items()):
+            try: await self._restore_guild(guild_id, snapshot)
+            except Exception as e:
+                logger.error(f"Falha ao restaurar o estado do servidor {guild_id}: {e}", exc_info=e)
+                self.guild_states.pop(guild_id, None); self.state_journal.forget(guild_id)
+            await asyncio.sleep(STATE_RESTORE_STAGGER) # Restaura aos poucos para não gerar um pico de buscas/conexões
+
+    async def _restore_guild(self, guild_id: int, snapshot: dict):
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(snapshot['voice_channel']) if guild else None
+        if not channel or guild.voice_client or not any(not m.bot for m in getattr(channel, 'members', [])):
+            self.state_journal.forget(guild_id); return
+        members: Dict[int, discord.Member] = {}
+        async def member(member_id: int) -> discord.Member:
+            if member_id not in members:
+                found = guild.get_member(member_id)
+                if not found:
+                    try: found = await guild.fetch_member(member_id)
+                    except discord.HTTPException: found = guild.me
+                members[member_id] = found
+            return members[member_id]
+        state = self.get_guild_state(guild_id)
+        state.volume = snapshot.get('volume', state.volume); state.loop_state = LoopState[snapshot.get('loop', 'NONE')]
+        state.prefetch_depth = snapshot.get('prefetch_depth', state.prefetch_depth)
+        state.effects = [name for name in snapshot.get('effects', []) if name in AUDIO_EFFECTS]
+        # As músicas voltam só com a identidade; as URLs são resolvidas na hora de tocar.
+        if snapshot.get('current'):
+            current = Song(snapshot['current'], await member(snapshot['current']['requester']))
+            current.resume_at = snapshot.get('position') or 0.0
+            state.song_queue.append(current)
+        for identity in snapshot.get('queue', []): state.song_queue.append(Song(identity, await member(identity['requester'])))
+        await self._connect_voice(channel)
+        if snapshot.get('menu'):
+            text_channel = guild.get_channel(snapshot['menu'][0])
+            if text_channel: state.menu_message = text_channel.get_partial_message(snapshot['menu'][1])
+        playlist = snapshot.get('playlist')
+        if playlist and snapshot.get('tracks'):
+            state.playlist_mode = True; state.playlist_requester = await member(playlist['requester'])
+            state.playlist_tracks_to_search = [PlaylistTrack(*track) for track in snapshot['tracks']]
+            state.playlist_total_tracks = playlist['total']; state.playlist_loaded_tracks = playlist['loaded']
+            state.playlist_loader_task = self.bot.loop.create_task(self._playlist_peer_loader_loop(guild_id, state.playlist_requester, None))
+        state.player_task = self.bot.loop.create_task(self._player_loop(guild_id))
+        logger.info(f"Estado do servidor '{guild.name}' restaurado ({len(state.song_queue)} músicas).")
+
     async def _cleanup(self, guild: discord.Guild):
         state = self.get_guild_state(guild.id)
         if state.player_task: state.player_task.cancel()
         if state.playlist_loader_task: state.playlist_loader_task.cancel()
+        if state.playlist_fetch_task: state.playlist_fetch_task.cancel()
+        if state.menu_render_task: state.menu_render_task.cancel()
+        if state.prefetch_task: state.prefetch_task.cancel()
+        self._discard_warm_source(state)
         if guild.voice_client: await guild.voice_client.disconnect()
+        self.admission.wake() # Uma vaga foi liberada
         if state.menu_message:
             try:
                 embed = discord.Embed(title="Player Desconectado", description="Até a próxima! 👋", color=discord.Color.red())
@@ -309,11 +1602,12 @@ class MusicCog(commands.Cog, name="Music"):
                 await state.menu_message.edit(embed=embed, view=None)
             except (discord.NotFound, discord.HTTPException): pass
         if guild.id in self.guild_states: del self.guild_states[guild.id]
+        self.dirty_states.discard(guild.id); self.state_journal.forget(guild.id)
         logger.info(f"Estado do servidor '{guild.name}' foi limpo.")
 
     def _player_finished_callback(self, state: GuildState, error=None):
         if error: logger.error(f"Erro no player: {error}", exc_info=error)
-        else: logger.info(f"Reprodução de '{state.current_song.title}' finalizada.")
+        else: logger.info(f"Reprodução de '{state.current_song.title}' finalizada.", extra={'sampled': True, 'guild_id': state.guild_id})
         state.play_next_song.set()
 
     async def _player_loop(self, guild_id: int):
@@ -327,6 +1621,7 @@ class MusicCog(commands.Cog, name="Music"):
                 logger.warning(f"Player loop detectou desconexão. Limpando."); return await self._cleanup(guild)
             try:
                 song_to_play = await asyncio.wait_for(state.song_queue.get(), timeout=300.0)
+                async with state.queue_changed: state.queue_changed.notify_all()
             except asyncio.TimeoutError:
                 logger.info(f"Fila vazia por 5 minutos. Desconectando.")
                 if vc and not vc.is_playing():
@@ -334,12 +1629,19 @@ class MusicCog(commands.Cog, name="Music"):
                        await state.menu_message.channel.send("Fila vazia. Desconectando por inatividade.", delete_after=30)
                    return await self._cleanup(guild)
                 continue
-            state.current_song = song_to_play
+            state.current_song = song_to_play; state.skip_requested = False; played = False; state.mark_dirty()
+            source_url = await self._playable_url(song_to_play)
             try:
-                source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(song_to_play.source_url, **FFMPEG_OPTIONS), volume=state.volume)
+                if not source_url: raise RuntimeError(f"Não foi possível obter o stream de '{song_to_play.title}'.")
+                if song_to_play.resume_at: source = self._create_source(state, song_to_play, source_url, start_at=song_to_play.resume_at)
+                else: source = self._take_warm_source(state, song_to_play) or self._create_source(state, song_to_play, source_url)
                 vc.play(source, after=lambda e: self._player_finished_callback(state, e))
-                state.song_start_time = time.time()
-                logger.info(f"Iniciando reprodução de '{song_to_play.title}'.")
+                state.current_source = source
+                song_to_play.resume_at = 0.0
+                logger.info(f"Iniciando reprodução de '{song_to_play.title}'.", extra={'sampled': True, 'guild_id': guild_id})
+                self.audio_cache.record_play(song_to_play, source_url, self.bot.loop)
+                self._schedule_loudness(song_to_play, source_url)
+                self._schedule_prefetch(state, song_to_play); played = True
             except Exception as e:
                 logger.error(f"Erro CRÍTICO ao iniciar a reprodução: {e}", exc_info=True)
                 if state.menu_message and state.menu_message.channel:
@@ -347,15 +1649,140 @@ class MusicCog(commands.Cog, name="Music"):
                 state.play_next_song.set()
             await state.update_menu()
             await state.play_next_song.wait()
+            if not played: continue
+            position = self._playback_position(state); state.current_source = None
+            if not state.skip_requested and song_to_play.duration and position < song_to_play.duration - RESUME_TOLERANCE and song_to_play.resume_attempts < RESUME_MAX_ATTEMPTS:
+                # O stream caiu no meio da música: renova a URL e retoma do ponto onde parou.
+                logger.warning(f"Stream de '{song_to_play.title}' terminou em {position:.0f}s de {song_to_play.duration}s. Retomando.")
+                song_to_play.resume_attempts += 1; song_to_play.resume_at = position; song_to_play.source_url = None
+                state.song_queue.insert(0, song_to_play); continue
+            song_to_play.resume_attempts = 0
+            # Loop da música repete a mesma faixa (a não ser que tenha sido pulada); loop da fila a devolve ao fim.
+            if state.loop_state == LoopState.SONG and not state.skip_requested: state.song_queue.insert(0, song_to_play)
+            elif state.loop_state == LoopState.QUEUE: state.song_queue.append(song_to_play)
+
+    # --- Resolução Just-in-Time do Stream ---
+    async def _refresh_stream(self, song: Song) -> Optional[str]:
+        url = self.search_cache.get_stream(song.video_id) if song.video_id else None
+        if url: song.set_stream(url)
+        if song.stream_valid: return song.source_url
+        await self.search_rate_limiter.acquire()
+        data = await self.extractors.run('extract', song.webpage_url)
+        if not data or not data.get('url'):
+            logger.warning(f"Não foi possível renovar o stream de '{song.title}'."); return None
+        song.set_stream(data['url'])
+        if song.video_id: self.search_cache.put_stream(song.video_id, data['url'])
+        return song.source_url
+
+    async def _playable_url(self, song: Song) -> Optional[str]:
+        # Uma cópia local dispensa qualquer acesso ao YouTube.
+        return self.audio_cache.lookup(song.video_id) or await self._resolve_stream(song)
+
+    async def _resolve_stream(self, song: Song) -> Optional[str]:
+        if song.stream_valid: return song.source_url
+        # Reaproveita uma renovação já em andamento (ex.: a disparada em segundo plano).
+        if not song.refresh_task or song.refresh_task.done():
+            song.refresh_task = self.bot.loop.create_task(self._refresh_stream(song))
+        try: return await asyncio.shield(song.refresh_task)
+        except Exception as e:
+            logger.error(f"Erro ao resolver o stream de '{song.title}': {e}"); return None
+
+    # --- Normalização de Loudness ---
+    def _track_gain(self, song: Optional[Song]) -> float:
+        if not LOUDNESS_NORMALIZATION or not song or not song.video_id: return 0.0
+        return loudness_gain(self.search_cache.get_loudness(song.video_id))
+
+    def _schedule_loudness(self, song: Song, url: str):
+        # Mede uma única vez por vídeo; o resultado vale para todas as próximas reproduções.
+        if not LOUDNESS_NORMALIZATION or not song.video_id or song.video_id in self.loudness_pending: return
+        if self.search_cache.get_loudness(song.video_id) is not None: return
+        self.loudness_pending.add(song.video_id)
+        self.bot.loop.create_task(self._measure_loudness(song, url))
+
+    async def _measure_loudness(self, song: Song, url: str):
+        try:
+            # Pool separado: uma análise de minutos não segura um worker de busca.
+            lufs = await self.loudness_workers.run('loudness', url, timeout=LOUDNESS_TIMEOUT)
+            if lufs is None: return
+            self.search_cache.put_loudness(song.video_id, lufs)
+            logger.info(f"Loudness de '{song.title}': {lufs:.1f} LUFS (ganho {loudness_gain(lufs):+.1f} dB).", extra={'sampled': True})
+        except Exception as e: logger.warning(f"Falha ao medir a loudness de '{song.title}': {e}")
+        finally: self.loudness_pending.discard(song.video_id)
+
+    # --- Pipeline de Prefetch ---
+    def _schedule_prefetch(self, state: GuildState, current: Song):
+        if state.prefetch_task: state.prefetch_task.cancel()
+        state.prefetch_task = self.bot.loop.create_task(self._prefetch_upcoming(state, current))
+
+    async def _prefetch_upcoming(self, state: GuildState, current: Song):
+        if state.prefetch_depth <= 0: return
+        # Fase 1: enquanto a música atual toca, resolve em paralelo as próximas N da fila.
+        upcoming = state.song_queue.slice(0, state.prefetch_depth)
+        urls = await asyncio.gather(*(self._playable_url(song) for song in upcoming))
+        for song, url in zip(upcoming, urls):
+            if url: self._schedule_loudness(song, url)
+        # Fase 2: perto do fim, revalida a próxima música e já deixa o FFmpeg dela conectado.
+        speed = compile_effects(state.effects)[1] # Com efeitos de tempo a música acaba antes (ou depois) da duração nominal
+        await asyncio.sleep(max(0, (current.duration - self._playback_position(state)) / speed - STREAM_REFRESH_LEAD))
+        if state.song_queue.empty() or state.current_song is not current: return
+        next_song = state.song_queue.peek()
+        url = await self._playable_url(next_song)
+        if url and PREFETCH_WARM_FFMPEG: self._warm_source(state, next_song, url)
+
+    def _warm_source(self, state: GuildState, song: Song, url: str):
+        self._discard_warm_source(state)
+        try: state.warm_source = (song, self._create_source(state, song, url), state.volume)
+        except Exception as e: logger.warning(f"Não foi possível pré-abrir o FFmpeg de '{song.title}': {e}")
+
+    def _discard_warm_source(self, state: GuildState):
+        if state.warm_source:
+            state.warm_source[1].cleanup(); state.warm_source = None
+
+    def _take_warm_source(self, state: GuildState, song: Song) -> Optional[discord.AudioSource]:
+        # Só reaproveita se a música pré-aberta for de fato a que vai tocar (a fila ou o volume podem ter mudado).
+        if state.warm_source and state.warm_source[0] is song and state.warm_source[2] == state.volume:
+            audio = state.warm_source[1]; state.warm_source = None
+            return audio
+        self._discard_warm_source(state)
+        return None
 
     async def _search_song(self, query: str, requester: discord.Member) -> Optional[Song]:
         try:
-            data = await self.bot.loop.run_in_executor(self.process_executor, search_sync, query)
+            # Um acerto no cache basta para enfileirar: a URL de stream é resolvida perto da hora de tocar.
+            data = self.search_cache.get(query)
             if data: return Song(data, requester)
+            await self.admission.search_gate(); await self.search_rate_limiter.acquire()
+            if FLAT_SEARCH:
+                candidates = await self.extractors.run('candidates', query, 1)
+                data = candidates[0] if candidates else None
+            else: data = await self.extractors.run('search', query)
+            if data:
+                self.search_cache.put(query, data)
+                return Song(data, requester)
             logger.warning(f"Nenhum resultado encontrado para: '{query}'"); return None
         except Exception as e:
             logger.error(f"Erro ao buscar '{query}': {e}"); return None
 
+    async def _search_track(self, track: PlaylistTrack, requester: discord.Member) -> Optional[Song]:
+        """Resolve uma faixa do Spotify: primeiro pelo índice de ISRC, depois pelo melhor de N candidatos."""
+        try:
+            data = (self.search_cache.get_isrc(track.isrc) if track.isrc else None) or self.search_cache.get(track.query)
+            if data: return Song(data, requester)
+            await self.admission.search_gate(); await self.search_rate_limiter.acquire()
+            candidates = await self.extractors.run('candidates', track.query, SPOTIFY_MATCH_CANDIDATES)
+            best = pick_best_candidate(track, candidates)
+            if not best:
+                if not candidates: return None
+                # O primeiro candidato é o mesmo que a busca padrão traria: usa ele em vez de buscar de novo.
+                logger.info(f"Nenhum candidato confiável para '{track.query}'. Usando o primeiro resultado.", extra={'sampled': True, 'guild_id': requester.guild.id})
+                self.search_cache.put(track.query, candidates[0])
+                return Song(candidates[0], requester)
+            if track.isrc: self.search_cache.put_isrc(track.isrc, best)
+            self.search_cache.put(track.query, best)
+            return Song(best, requester)
+        except Exception as e:
+            logger.error(f"Erro ao buscar a faixa '{track.query}': {e}"); return None
+
     def build_player_embed(self, state: GuildState) -> discord.Embed:
         if state.current_song:
             song = state.current_song
@@ -365,6 +1792,7 @@ class MusicCog(commands.Cog, name="Music"):
             embed.add_field(name="Duração", value=f"`{m}:{s:02d}`", inline=True)
             embed.add_field(name="Pedido por", value=song.requester.mention, inline=True)
             embed.add_field(name="Volume", value=f"`{int(state.volume * 100)}%`", inline=True)
+            if state.effects: embed.add_field(name="Efeitos", value=', '.join(AUDIO_EFFECTS[name][0] for name in state.effects), inline=False)
             queue_text = f"📜 Fila: {state.song_queue.qsize()}"
             if state.playlist_mode: queue_text += f" (+{len(state.playlist_tracks_to_search)} a buscar)"
             queue_text += f" | Loop: {state.loop_state.name.capitalize()}"
@@ -374,30 +1802,70 @@ class MusicCog(commands.Cog, name="Music"):
         embed.set_footer(text=f"{queue_text}\nDesenvolvido por: Douglas Batista")
         return embed
 
-    async def _playlist_peer_loader_loop(self, guild_id: int, requester: discord.Member, initial_message: discord.Message):
+    def _spotify_tracks(self, page: dict) -> List[PlaylistTrack]:
+        tracks = []
+        for item in page.get('items', []):
+            track = item.get('track')
+            if not track or not track.get('artists'): continue
+            tracks.append(PlaylistTrack(track['name'], track['artists'][0]['name'], (track.get('external_ids') or {}).get('isrc'), int(track.get('duration_ms') or 0) // 1000))
+        return tracks
+
+    def _fetch_spotify_page(self, playlist_id: str, offset: int) -> dict:
+        return self.spotify_client.playlist_items(playlist_id, fields=SPOTIFY_PLAYLIST_FIELDS, limit=SPOTIFY_PAGE_SIZE, offset=offset, market="BR", additional_types=('track',))
+
+    async def _fetch_remaining_pages(self, state: GuildState, playlist_id: str, page: dict):
+        # Segue as páginas do Spotify em segundo plano enquanto as primeiras músicas já tocam.
+        offset = 0
+        try:
+            while page.get('next'):
+                offset += SPOTIFY_PAGE_SIZE
+                page = await self.bot.loop.run_in_executor(None, self._fetch_spotify_page, playlist_id, offset)
+                state.add_playlist_tracks(self._spotify_tracks(page))
+                async with state.queue_changed: state.queue_changed.notify_all()
+        except asyncio.CancelledError: raise
+        except Exception as e: logger.error(f"Erro ao paginar a playlist '{playlist_id}': {e}", exc_info=e)
+        state.playlist_fetch_done = True
+        async with state.queue_changed: state.queue_changed.notify_all()
+        logger.info(f"Todas as páginas da playlist '{playlist_id}' foram lidas.")
+
+    async def _resolve_in_order(self, tracks: List[PlaylistTrack], requester: discord.Member):
+        # Resolve as buscas em paralelo (limitado), mas entrega os resultados na ordem da playlist.
+        semaphore = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+        async def resolve(track: PlaylistTrack) -> Optional[Song]:
+            async with semaphore: return await self._search_track(track, requester)
+        tasks = [self.bot.loop.create_task(resolve(track)) for track in tracks]
+        try:
+            for task in tasks: yield await task
+        finally:
+            for task in tasks: task.cancel()
+
+    async def _playlist_peer_loader_loop(self, guild_id: int, requester: discord.Member, initial_message: Optional[discord.Message]):
         state = self.get_guild_state(guild_id)
         logger.info(f"Iniciando carregador de playlist.")
-        if state.playlist_tracks_to_search:
-            first_query = state.playlist_tracks_to_search.pop(0)
-            await initial_message.edit(content=f"▶️ Buscando a primeira música: `{first_query[:50]}...`")
-            first_song = await self._search_song(first_query, requester)
+        if state.playlist_tracks_to_search and initial_message:
+            first_track = state.take_playlist_tracks(1)[0]
+            await initial_message.edit(content=f"▶️ Buscando a primeira música: `{first_track.query[:50]}...`")
+            first_song = await self._search_track(first_track, requester)
             if first_song:
-                await state.song_queue.put(first_song); state.playlist_loaded_tracks += 1
+                state.song_queue.put(first_song); state.playlist_loaded_tracks += 1; state.mark_dirty()
                 await initial_message.edit(content=f"Tocando `{first_song.title}`. Carregando as outras {len(state.playlist_tracks_to_search) + 1} músicas...")
             else: await initial_message.edit(content=f"Não achei a primeira música. Tentando a próxima...")
-        while state.playlist_tracks_to_search:
+        def ready() -> bool:
+            # Há o que buscar e a fila baixou até o limite, ou acabou tudo (inclusive as páginas do Spotify).
+            if not state.playlist_tracks_to_search: return state.playlist_fetch_done
+            return state.song_queue.qsize() <= PEER_THRESHOLD
+        while state.playlist_tracks_to_search or not state.playlist_fetch_done:
             try:
-                if state.song_queue.qsize() <= PEER_THRESHOLD:
-                    queries = [state.playlist_tracks_to_search.pop(0) for _ in range(min(PEER_SIZE, len(state.playlist_tracks_to_search)))]
-                    for query in queries:
-                        song = await self._search_song(query, requester)
-                        if song: await state.song_queue.put(song); state.playlist_loaded_tracks += 1
-                        await asyncio.sleep(0.5)
-                    await state.update_menu()
-                await asyncio.sleep(5)
+                # Espera a fila esvaziar até o limite (ou novas páginas chegarem), sem polling.
+                async with state.queue_changed: await state.queue_changed.wait_for(ready)
+                if not state.playlist_tracks_to_search: break
+                tracks = state.take_playlist_tracks(PEER_SIZE)
+                async for song in self._resolve_in_order(tracks, requester):
+                    if song: state.song_queue.put(song); state.playlist_loaded_tracks += 1
+                state.mark_dirty(); await state.update_menu()
             except asyncio.CancelledError: logger.info(f"Carregador de playlist cancelado."); break
             except Exception as e: logger.error(f"Erro no carregador de playlist: {e}", exc_info=e); break
-        state.playlist_mode = False
+        state.playlist_mode = False; state.mark_dirty()
         logger.info(f"Carregador de playlist concluído.")
 
     # --- Lógica Centralizada de Playlist ---
@@ -441,15 +1909,15 @@ class MusicCog(commands.Cog, name="Music"):
             initial_message = await channel.send(f"🔍 Analisando playlist...")
 
         try:
-            items = await self.bot.loop.run_in_executor(None, lambda: self.spotify_client.playlist_tracks(playlist_id, market="BR")['items'])
-            if not items:
+            first_page = await self.bot.loop.run_in_executor(None, self._fetch_spotify_page, playlist_id, 0)
+            if not first_page.get('items'):
                 msg = "Playlist vazia ou não encontrada."
                 if is_interaction: await interaction_or_ctx.followup.send(msg, ephemeral=True)
                 else: await initial_message.edit(content=msg)
                 return
             
             if not guild.voice_client:
-                try: await author.voice.channel.connect()
+                try: await self._connect_voice(author.voice.channel)
                 except Exception as e:
                     msg = f"Não consegui conectar ao seu canal de voz: {e}"
                     if is_interaction: await interaction_or_ctx.followup.send(msg, ephemeral=True)
@@ -459,8 +1927,8 @@ class MusicCog(commands.Cog, name="Music"):
             state.reset_playlist_state()
             state.playlist_mode = True
             state.playlist_requester = author
-            state.playlist_tracks_to_search = [f"{item['track']['name']} {item['track']['artists'][0]['name']}" for item in items if item.get('track')]
-            state.playlist_total_tracks = len(state.playlist_tracks_to_search)
+            state.set_playlist_tracks(self._spotify_tracks(first_page))
+            state.playlist_total_tracks = first_page.get('total') or len(state.playlist_tracks_to_search)
             
             if not state.playlist_tracks_to_search:
                 msg = "Não extraí músicas válidas da playlist."
@@ -474,6 +1942,9 @@ class MusicCog(commands.Cog, name="Music"):
             if not state.player_task or state.player_task.done():
                 state.player_task = self.bot.loop.create_task(self._player_loop(guild.id))
             
+            if first_page.get('next'):
+                state.playlist_fetch_done = False
+                state.playlist_fetch_task = self.bot.loop.create_task(self._fetch_remaining_pages(state, playlist_id, first_page))
             state.playlist_loader_task = self.bot.loop.create_task(self._playlist_peer_loader_loop(guild.id, author, initial_message))
 
         except spotipy.exceptions.SpotifyException as e:
@@ -498,11 +1969,12 @@ class MusicCog(commands.Cog, name="Music"):
         await interaction.response.defer(ephemeral=True, thinking=True)
         if not interaction.user.voice: return await interaction.followup.send("Você precisa estar em um canal de voz!", ephemeral=True)
         if not interaction.guild.voice_client:
-            try: await interaction.user.voice.channel.connect()
+            try: await self._connect_voice(interaction.user.voice.channel)
             except Exception as e: return await interaction.followup.send(f"Não consegui conectar: {e}", ephemeral=True)
+        if state.song_queue.full: return await interaction.followup.send(f"A fila está cheia ({state.song_queue.soft_limit} músicas).", ephemeral=True)
         song = await self._search_song(busca, interaction.user)
         if not song: return await interaction.followup.send(f"Não encontrei a música `{busca}`.", ephemeral=True)
-        await state.song_queue.put(song)
+        state.song_queue.put(song); state.mark_dirty()
         await interaction.followup.send(f"✅ Adicionado à fila: **{song.title}**", ephemeral=True)
         if not state.player_task or state.player_task.done(): state.player_task = self.bot.loop.create_task(self._player_loop(interaction.guild_id))
         if not state.menu_message or not state.menu_message.channel:
@@ -525,15 +1997,18 @@ class MusicCog(commands.Cog, name="Music"):
     async def list_command(self, interaction: discord.Interaction, url: str):
         await self._add_playlist(interaction, url)
 
-    @commands.command(name="status", help="Mostra o status da playlist em andamento.")
+    @commands.command(name="status", help="Mostra o status da playlist em andamento e a capacidade do bot.")
     @is_not_banned()
     async def status(self, ctx: commands.Context):
         state = self.get_guild_state(ctx.guild.id)
-        if not state.playlist_mode or not state.playlist_requester: return await ctx.send("Nenhuma playlist está em processamento.")
-        embed = discord.Embed(title="Status da Playlist", color=discord.Color.blue())
-        embed.add_field(name="Status", value="Playlist em processamento", inline=False)
-        embed.add_field(name="Pedido por", value=state.playlist_requester.mention, inline=False)
-        embed.add_field(name="Progresso", value=f"`{state.playlist_loaded_tracks} / {state.playlist_total_tracks}` músicas carregadas", inline=False)
+        if not state.playlist_mode or not state.playlist_requester:
+            embed = discord.Embed(title="Status", description="Nenhuma playlist está em processamento.", color=discord.Color.greyple())
+        else:
+            embed = discord.Embed(title="Status da Playlist", color=discord.Color.blue())
+            embed.add_field(name="Status", value="Playlist em processamento", inline=False)
+            embed.add_field(name="Pedido por", value=state.playlist_requester.mention, inline=False)
+            embed.add_field(name="Progresso", value=f"`{state.playlist_loaded_tracks} / {state.playlist_total_tracks}` músicas carregadas", inline=False)
+        embed.add_field(name="Capacidade", value=self.admission.describe(), inline=False)
         embed.set_footer(text=f"Fila atual: {state.song_queue.qsize()} músicas prontas para tocar.\nDesenvolvido por: Douglas Batista")
         await ctx.send(embed=embed)
 
@@ -570,9 +2045,9 @@ class MusicCog(commands.Cog, name="Music"):
     @is_not_banned()
     async def nowplaying(self, interaction: discord.Interaction):
         state = self.get_guild_state(interaction.guild_id)
-        if not state.current_song or not state.song_start_time:
+        if not state.current_song or not state.current_source:
             return await interaction.response.send_message("Não há nenhuma música tocando.", ephemeral=True)
-        song = state.current_song; elapsed = time.time() - state.song_start_time
+        song = state.current_song; elapsed = self._playback_position(state)
         progress_bar_length = 20
         progress_percent = min(elapsed / song.duration, 1.0) if song.duration > 0 else 0
         filled_blocks = int(progress_percent * progress_bar_length)
@@ -593,15 +2068,15 @@ class MusicCog(commands.Cog, name="Music"):
         desc = ""
         if state.current_song: desc += f"**Tocando Agora:**\n`▶️` {state.current_song.title}\n\n"
         desc += "**Próximas na fila:**\n"
-        queue_list = list(state.song_queue._queue)
+        queue_list = state.song_queue.slice(0, 10); queue_size = len(state.song_queue)
         if not queue_list: desc += "Nenhuma música na fila.\n"
         else:
-            lines = [f"`{i+1}.` {song.title}" for i, song in enumerate(queue_list[:10])]
+            lines = [f"`{i+1}.` {song.title}" for i, song in enumerate(queue_list)]
             desc += "\n".join(lines)
         if state.playlist_mode:
             desc += f"\n\n**Aguardando busca:**\n`+{len(state.playlist_tracks_to_search)}` músicas da playlist."
         embed.description = desc
-        if len(queue_list) > 10: embed.set_footer(text=f"... e mais {len(queue_list) - 10} música(s).")
+        if queue_size > 10: embed.set_footer(text=f"... e mais {queue_size - 10} música(s).")
         await interaction.response.send_message(embed=embed, ephemeral=ephemeral)
 
     @app_commands.command(name="queue", description="Mostra a fila de músicas.")
@@ -609,17 +2084,77 @@ class MusicCog(commands.Cog, name="Music"):
     async def queue_command(self, interaction: discord.Interaction):
         await self.show_queue(interaction)
 
+    @app_commands.command(name="prefetch", description="Define quantas músicas da fila são pré-carregadas (0 desativa).")
+    @is_not_banned()
+    async def prefetch(self, interaction: discord.Interaction, quantidade: app_commands.Range[int, 0, PREFETCH_DEPTH_MAX]):
+        if not interaction.user.guild_permissions.manage_guild:
+            return await interaction.response.send_message("🚫 Apenas administradores podem usar esta função.", ephemeral=True)
+        state = self.get_guild_state(interaction.guild_id)
+        state.prefetch_depth = quantidade; state.mark_dirty()
+        if quantidade == 0: self._discard_warm_source(state)
+        await interaction.response.send_message(f"⚡ Pré-carregamento ajustado para **{quantidade}** música(s).", ephemeral=True)
+
+    @app_commands.command(name="shuffle", description="Embaralha as músicas da fila.")
+    @is_not_banned()
+    async def shuffle(self, interaction: discord.Interaction):
+        state = self.get_guild_state(interaction.guild_id)
+        if len(state.song_queue) < 2: return await interaction.response.send_message("Não há músicas suficientes na fila para embaralhar.", ephemeral=True)
+        state.song_queue.shuffle(); state.mark_dirty()
+        await interaction.response.send_message("🔀 Fila embaralhada!", ephemeral=True)
+        await state.update_menu()
+
+    @app_commands.command(name="seek", description="Pula para um ponto da música atual (ex.: 90, 1:30).")
+    @is_not_banned()
+    async def seek(self, interaction: discord.Interaction, posicao: str):
+        vc = interaction.guild.voice_client
+        state = self.get_guild_state(interaction.guild_id)
+        if not self._player_active(state, vc): return await interaction.response.send_message("O bot não está tocando nada.", ephemeral=True)
+        target = parse_timestamp(posicao)
+        if target is None: return await interaction.response.send_message("Posição inválida. Use segundos ou `mm:ss`.", ephemeral=True)
+        if state.current_song.duration and target >= state.current_song.duration:
+            return await interaction.response.send_message("Essa posição está além do fim da música.", ephemeral=True)
+        await interaction.response.defer(ephemeral=True)
+        if not await self._restart_source(state, vc, target): return await interaction.followup.send("Não foi possível avançar a música.", ephemeral=True)
+        m, s = divmod(int(target), 60)
+        await interaction.followup.send(f"⏩ Música posicionada em **{m}:{s:02d}**.", ephemeral=True)
+
     @app_commands.command(name="volume", description="Ajusta o volume do player (1 a 150%).")
     @is_not_banned()
     async def volume(self, interaction: discord.Interaction, valor: app_commands.Range[int, 1, 150]):
         vc = interaction.guild.voice_client
         if not vc or not vc.source: return await interaction.response.send_message("O bot não está tocando nada.", ephemeral=True)
         state = self.get_guild_state(interaction.guild_id)
-        state.volume = valor / 100
-        vc.source.volume = state.volume
+        state.volume = valor / 100; state.mark_dirty()
+        original = getattr(vc.source, 'original', vc.source)
+        if isinstance(original, discord.PCMVolumeTransformer): original.volume = state.volume * gain_factor(self._track_gain(state.current_song))
+        # Nas fontes Opus o volume é aplicado no FFmpeg: troca a fonte a partir do ponto atual.
+        else: await self._restart_source(state, vc, self._playback_position(state))
         await interaction.response.send_message(f"🔊 Volume ajustado para **{valor}%**.", ephemeral=True)
         await state.update_menu()
 
+    @app_commands.command(name="efeito", description="Liga ou desliga um efeito de áudio (bass boost, nightcore, 8D...).")
+    @app_commands.describe(efeito="Efeito a alternar; 'Desligar todos' remove todos os efeitos.")
+    @app_commands.choices(efeito=[app_commands.Choice(name=label, value=name) for name, (label, _, _, _) in AUDIO_EFFECTS.items()]
+                          + [app_commands.Choice(name="Desligar todos", value="off")])
+    @is_not_banned()
+    async def effect(self, interaction: discord.Interaction, efeito: app_commands.Choice[str]):
+        state = self.get_guild_state(interaction.guild_id)
+        name = efeito.value
+        if name == "off": state.effects = []; msg = "🎛️ Todos os efeitos foram desligados."
+        elif name in state.effects:
+            state.effects = [e for e in state.effects if e != name]; msg = f"🎛️ Efeito **{efeito.name}** desligado."
+        else:
+            group = AUDIO_EFFECTS[name][3]
+            state.effects = [e for e in state.effects if AUDIO_EFFECTS[e][3] != group] + [name]; msg = f"🎛️ Efeito **{efeito.name}** ligado."
+        # A fonte pré-aberta da próxima música foi montada com os efeitos antigos.
+        state.mark_dirty(); self._discard_warm_source(state)
+        await interaction.response.defer(ephemeral=True)
+        vc = interaction.guild.voice_client
+        # Entre músicas não há o que reiniciar: a próxima já nasce com os efeitos novos.
+        if self._player_active(state, vc): await self._restart_source(state, vc, self._playback_position(state))
+        await interaction.followup.send(msg, ephemeral=True)
+        await state.update_menu()
+
     async def stop_player(self, interaction: discord.Interaction):
         state = self.get_guild_state(interaction.guild.id)
         state.reset_playlist_state()
@@ -645,7 +2180,7 @@ class MusicCog(commands.Cog, name="Music"):
             except (discord.NotFound, discord.HTTPException): passa
         embed = self.build_player_embed(state)
         view = PlayerView(self, state)
-        state.menu_message = await interaction.channel.send(embed=embed, view=view)
+        state.menu_message = await interaction.channel.send(embed=embed, view=view); state.mark_dirty()
         await interaction.response.send_message("Painel recriado!", ephemeral=True, delete_after=5)
 
 async def setup(bot: commands.Bot):